@@ -1,28 +1,105 @@
 import model
+import async_db
 import re
 import tornado.web
+import tornado.gen
 import tornado.ioloop 
 import tornado.websocket
+import tornado.queues
 from datetime import datetime
-from tornado.escape import xhtml_escape
+from tornado.escape import xhtml_escape, json_encode, utf8
 import os
 import files
+import thumbnails
+import passwords
+import protocol
+import ratelimit
+import config
+import broker
+import multiprocessing
+import tornado.httpserver
+import tornado.httputil
+import tornado.netutil
+import tornado.process
+from typing_state import TypingAggregator
+from replay import REPLAY_BUFFER_SIZE, ReplayBuffer
+from read_state import ReadWatermarks
+from presence import PresenceRegistry
 import hashlib
+import hmac
+import tempfile
+import time
 import mimetypes
-import random
 import json
+import logging
+import logs
+import metrics
+
+log = logging.getLogger(__name__)
+access_log = logging.getLogger("tornado.access")
+
+
+# Room names are used in URLs and as keys, keep them simple
+ROOM_NAME = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
 
 
 class BaseHandler(tornado.web.RequestHandler):
 
     def get_current_user(self):
         return self.get_secure_cookie("user")
+    def set_session(self, username, user_id, **kwargs):
+        self.set_secure_cookie("user", username, **kwargs)
+        # The id travels with the name so handlers don't have to look it up
+        self.set_secure_cookie("user_id", f"{user_id}:{username}", **kwargs)
+    async def get_current_user_id(self):
+        session = self.get_secure_cookie("user_id")
+        username = self.current_user.decode("utf-8")
+        if session:
+            user_id, _, session_user = session.decode("utf-8").partition(":")
+            if session_user == username:
+                return int(user_id)
+        # Sessions from before the id was stored fall back to the shared cache
+        return await self.get_db().get_user_id(username)
     def get_db(self):
-        return model.chat_db() 
+        return self.settings['db']
+    def get_room(self):
+        room = self.get_argument("room", model.DEFAULT_ROOM)
+        if not ROOM_NAME.match(room):
+            raise ValueError("Invalid room name")
+        return room
     def prepare(self):
         # Set JSON headers for API responses
         if self.request.path.startswith('/api/'):
             self.set_header('Content-Type', 'application/json')    
+    def admit(self, limit, amount=1):
+        """Take `amount` from the current user's `limit` rate limit; False,
+        with a 429 response written, when the user is over it"""
+        wait = self.settings['rate_limits'][limit].consume(self.current_user, amount)
+        if not wait:
+            return True
+        self.rate_limited(limit, wait)
+        return False
+    def admit_upload(self, size):
+        """Charge an upload already read into memory to the user's byte rate,
+        like UploadHandler does while streaming; False, with a 429 response
+        written, when earlier uploads are already UPLOAD_MAX_WAIT ahead"""
+        limiter = self.settings['rate_limits']['uploads']
+        wait = limiter.debt(self.current_user)
+        if wait > config.UPLOAD_MAX_WAIT:
+            self.rate_limited("uploads", wait)
+            return False
+        limiter.borrow(self.current_user, size)
+        return True
+    def rate_limited(self, limit, wait):
+        metrics.RATE_LIMITED.labels(limit).inc()
+        retry_after = ratelimit.retry_after(wait)
+        self.set_status(429)
+        self.set_header("Retry-After", retry_after)
+        self.write({
+            "status": "error",
+            "message": f"Too many requests, try again in {retry_after} s",
+            "type": "rate_limited"
+        })
     
 class MainHandler(BaseHandler):
     def get(self):
@@ -42,9 +119,9 @@ class LoginHandler(BaseHandler):
         password = self.get_body_argument("password")
 
         DB = self.get_db()
-        user = DB.authenticate_user(username, password)
+        user = await DB.authenticate_user(username, password)
         if user:
-            self.set_secure_cookie("user", username, httponly=True)
+            self.set_session(username, user[0][0], httponly=True)
             self.redirect("/chat")
 
         else:
@@ -93,8 +170,8 @@ class SignupHandler(BaseHandler):
 
     
         DB = self.get_db()
-        if DB.create_user(username, password):
-            self.set_secure_cookie("user", username)
+        if await DB.create_user(username, password):
+            self.set_session(username, await DB.get_user_id(username))
             self.set_status(201)
             self.redirect("/chat")
         else:
@@ -105,18 +182,27 @@ class LogoutHandler(BaseHandler):
     
     def get(self):
         self.clear_cookie("user")
+        self.clear_cookie("user_id")
         self.redirect("/login")
 
+# History paging for GET /api/messages
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 100
+
+
 class MessageHandler(BaseHandler):
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self, message_id=None):
+        if self.request.path.startswith('/api/'):
+            if message_id is not None:
+                raise tornado.web.HTTPError(405)
+            return await self.get_history()
+
         try:
             DB = self.get_db()
-            messages = DB.get_message()
-            
-            # Debug output
-            print(f"Retrieved messages: {messages}")
+            room = self.get_room()
+            messages = await DB.get_message(room=room)
             
             if messages is None:
                 raise Exception("Database query failed")
@@ -124,48 +210,97 @@ class MessageHandler(BaseHandler):
             self.render("chat.html",
                     messages=messages or [], 
                     current_user=self.current_user.decode("utf-8"),
+                    room=room,
                     error=None)
             
-        except Exception as e:
-            print(f"Error in chat handler: {str(e)}")
+        except Exception:
+            log.exception("Error in chat handler")
             self.render("error.html", 
                     error="Could not load chat messages",
                     current_user=self.current_user.decode("utf-8"))
 
+    async def get_history(self):
+        """GET /api/messages?before=<id>&before_time=<timestamp>&limit=N
+
+        Returns one page of history, newest first, plus the cursor for the
+        next (older) page.
+        """
+        try:
+            limit = int(self.get_argument("limit", HISTORY_PAGE_SIZE))
+            if not 1 <= limit <= MAX_HISTORY_PAGE_SIZE:
+                raise ValueError(f"limit must be between 1 and {MAX_HISTORY_PAGE_SIZE}")
+            before = self.get_argument("before", None)
+            before = int(before) if before is not None else None
+            before_time = self.get_argument("before_time", None)
+            room = self.get_room()
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"status": "error", "message": str(e), "type": "validation_error"})
+            return
+
+        DB = self.get_db()
+        messages = await DB.get_message(limit, before=before, before_time=before_time, room=room)
+        self.write({
+            "status": "success",
+            "data": {
+                "messages": [client_message(message) for message in messages],
+                "next_before": messages[-1]["id"] if len(messages) == limit else None
+            }
+        })
+
+
+    def admit_message(self):
+        """A post or edit costs one post, plus its bytes if a file came with it"""
+        if not self.admit("posts"):
+            return False
+        attachments = self.request.files.get("attachment")
+        return not attachments or self.admit_upload(len(attachments[0]['body']))
 
     @tornado.web.authenticated
     async def post(self):
+        if not self.admit_message():
+            return
         try:
             content = xhtml_escape(self.get_argument("content")).strip()
+            room = self.get_room()
             DB = self.get_db()
             username = self.current_user.decode("utf-8")
-            user_id = DB.get_user(username)[0][0]
-            attachment_id = None
+            user_id = await self.get_current_user_id()
+            attachment_id = await self.get_uploaded_attachment(user_id)
 
             # Handle file attachment if present
             if 'attachment' in self.request.files and self.request.files["attachment"]:
-                attachment_id = await self.process_attachment(self.request.files['attachment'][0], username)
+                attachment_id = await self.process_attachment(self.request.files['attachment'][0], user_id)
 
             # Save message to database
             timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            DB.save_message(user_id, content, timestamp, attachment_id)
+            message_id = await DB.save_message(user_id, content, timestamp, attachment_id, room)
+            if not message_id:
+                raise Exception("Message not saved")
+            self.message_changed(message_id)
 
             # Prepare complete message data
             message_data = {
-                "id": DB.cursor.lastrowid,
+                "id": message_id,
                 "username": username,
                 "content": content,
                 "timestamp": timestamp,
                 "has_attachment": bool(attachment_id),
-                "attachment": {
-                    "id": attachment_id,
-                    "file_name": self.request.files['attachment'][0]['filename'] if attachment_id else None,
-                    "mime_type": mimetypes.guess_type(self.request.files['attachment'][0]['filename'])[0] if attachment_id else None
-                } if attachment_id else None
+                "room": room,
+                "revision": 0,
+                "attachment": None
             }
+            if attachment_id:
+                attachment = await DB.get_attachment(attachment_id)
+                message_data["attachment"] = {
+                    "id": attachment_id,
+                    "file_name": attachment[0],
+                    "mime_type": attachment[2],
+                    "file_size": attachment[4]
+                }
 
-            # Broadcast to all WebSocket clients
-            WebSocketHandler.broadcast(message_data)
+            # Broadcast to the room's WebSocket clients
+            WebSocketHandler.broadcast(message_data, room)
 
             self.set_status(201)
             self.write({
@@ -185,7 +320,7 @@ class MessageHandler(BaseHandler):
                             "allowed_types": files.ALLOWED_MIME_TYPES
                         } if "file" in str(e).lower() else None
                     })
-        except Exception as e:
+        except Exception:
             self.set_status(500)
             self.write({
                 "status": "error",
@@ -193,24 +328,16 @@ class MessageHandler(BaseHandler):
                 "type": "server_error"
             })
 
-    async def process_attachment(self, file_info, username):
-        """Helper method to handle file uploads"""
+    async def process_attachment(self, file_info, user_id):
+        """Helper method to handle multipart file uploads; large files should
+        go through UploadHandler instead"""
         file_name = file_info['filename']
         file_body = file_info['body']
         
-        mime_type, _ = mimetypes.guess_type(file_name)
-        if not mime_type or mime_type not in files.ALLOWED_MIME_TYPES:
-            raise ValueError("Unsupported file type")
-        
-        file_ext = os.path.splitext(file_name)[1].lower()
-        if file_ext not in files.ALLOWED_MIME_TYPES.get(mime_type, []):
-            raise ValueError("Invalid file extension for type")
-        
+        mime_type, file_ext, max_size = files.check_file(file_name)
         file_size = len(file_body)
-        file_category = mime_type.split('/')[0]
-        if (file_category in files.MAX_FILE_SIZES and 
-            file_size > files.MAX_FILE_SIZES[file_category]):
-            raise ValueError(f"File exceeds maximum size for {file_category}")
+        if file_size > max_size:
+            raise ValueError(f"File exceeds maximum size for {mime_type.split('/')[0]}")
         
         file_hash = hashlib.sha256(file_body).hexdigest()
         upload_dir = self.settings['upload_dir']
@@ -219,83 +346,80 @@ class MessageHandler(BaseHandler):
         unique_filename = f"{file_hash}{file_ext}"
         file_path = os.path.join(upload_dir, unique_filename)
         
-        if not os.path.exists(file_path):
-            with open(file_path, 'wb') as f:
-                f.write(file_body)
+        # The database layer moves it into place unless the blob already exists
+        fd, temp_path = tempfile.mkstemp(dir=upload_dir, prefix=".upload-", suffix=".part")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(file_body)
         
         DB = self.get_db()
-        user_id = DB.get_user(username)[0][0]
-        return DB.save_attachment(
+        attachment_id = await DB.save_attachment(
             user_id=user_id,
             file_name=file_name,
             file_path=file_path,
             file_size=file_size,
             mime_type=mime_type,
-            hash_sha256=file_hash
+            hash_sha256=file_hash,
+            temp_path=temp_path
         )
+        if attachment_id:
+            metrics.UPLOAD_BYTES.inc(file_size)
+            self.settings['thumbnails'].submit(file_hash, file_path, mime_type)
+        return attachment_id
+
+    async def get_uploaded_attachment(self, user_id):
+        """Attachment id passed by a client that already used /api/uploads"""
+        attachment_id = self.get_argument("attachment_id", None)
+        if not attachment_id:
+            return None
+        attachment = await self.get_db().get_attachment(int(attachment_id))
+        if not attachment or attachment[3] != user_id:
+            raise ValueError("Unknown attachment")
+        return int(attachment_id)
+
+    def prepare(self):
+        super().prepare()
+        # script.js sends edits as JSON; expose them through get_argument
+        if self.request.headers.get("Content-Type", "").startswith("application/json") and self.request.body:
+            try:
+                body = json.loads(self.request.body)
+            except ValueError:
+                raise tornado.web.HTTPError(400, "Invalid JSON body")
+            if not isinstance(body, dict):
+                raise tornado.web.HTTPError(400, "Invalid JSON body")
+            for name, value in body.items():
+                if value is not None:
+                    self.request.arguments.setdefault(name, []).append(utf8(str(value)))
+
+    def message_changed(self, message_id):
+        """Have the other workers refresh their cached copy of the message"""
+        self.settings['broker'].publish("messages", utf8(f"{os.getpid()}:{message_id}"))
 
     @tornado.web.authenticated
     async def put(self, message_id):
+        if not self.admit_message():
+            return
         try:
             new_content = xhtml_escape(self.get_argument("new_content"))
             DB = self.get_db()
-            username = self.current_user.decode("utf-8")
-            user_id = DB.get_user(username)[0][0]
+            user_id = await self.get_current_user_id()
 
-            message = DB.get_message_by_id(message_id)
+            message = await DB.get_message_by_id(message_id)
             if not message or message[1] != user_id:
                 raise Exception("Unauthorized or message not found")
 
-            new_attachment = None
+            new_attachment_id = await self.get_uploaded_attachment(user_id)
             if 'attachment' in self.request.files and self.request.files["attachment"]:
-                file_info = self.request.files['attachment'][0]
-                file_name = file_info['filename']
-                file_body = file_info['body']
-                
-                # Determine MIME type based on file extension
-                mime_type, _ = mimetypes.guess_type(file_name)
-                if not mime_type:
-                    raise ValueError("Could not determine file type")
-                
-                if mime_type not in files.ALLOWED_MIME_TYPES:
-                    raise ValueError("File type not allowed")
-                
-                file_ext = os.path.splitext(file_name)[1].lower()
-                if file_ext not in files.ALLOWED_MIME_TYPES.get(mime_type, []):
-                    raise ValueError("File extension doesn't match MIME type")
-                
-                file_size = len(file_body)
-                file_category = mime_type.split('/')[0]  # 'image', 'video', etc.
-                if file_category in files.MAX_FILE_SIZES and file_size > files.MAX_FILE_SIZES[file_category]:
-                    raise ValueError(f"File too large for type {file_category}")
-
-                file_hash = hashlib.sha256(file_body).hexdigest()
-                upload_dir = "uploads"
-                if not os.path.exists(upload_dir):
-                    os.makedirs(upload_dir)
-                
-                unique_filename = f"{file_hash}{file_ext}"
-                file_path = os.path.join(upload_dir, unique_filename)
-                
-                if not os.path.exists(file_path):
-                    with open(file_path, 'wb') as f:
-                        f.write(file_body)
-                
-                new_attachment = {
-                    'file_name': file_name,
-                    'file_path': file_path,
-                    'file_size': file_size,
-                    'mime_type': mime_type,
-                    'hash_sha256': file_hash
-                }
+                new_attachment_id = await self.process_attachment(self.request.files['attachment'][0], user_id)
 
-            updated = DB.edit_message(
+            updated = await DB.edit_message(
                 message_id=message_id,
                 new_content=new_content,
-                new_attachment=new_attachment
+                new_attachment_id=new_attachment_id
             )
             
             if updated:
+                self.message_changed(message_id)
+                WebSocketHandler.broadcast_edit(await DB.get_message_detail(int(message_id)))
                 self.set_status(204)
             else:
                 raise Exception("Message not updated")
@@ -306,17 +430,21 @@ class MessageHandler(BaseHandler):
 
     @tornado.web.authenticated
     async def delete(self, message_id):
+        if not self.admit("posts"):
+            return
         try:
             DB = self.get_db()
-            username = self.current_user.decode("utf-8")
-            user_id = DB.get_user(username)[0][0]
+            user_id = await self.get_current_user_id()
 
-            message = DB.get_message_by_id(message_id)
+            message = await DB.get_message_by_id(message_id)
             if not message or message[1] != user_id:
                 raise Exception("Unauthorized or message not found")
 
-            deleted = DB.delete_message(message_id)
+            deleted = await DB.delete_message(message_id)
             if deleted:
+                self.message_changed(message_id)
+                # Deletion is final; its revision just orders it after any edit
+                WebSocketHandler.broadcast_delete(int(message_id), message[4], message[5] + 1)
                 self.set_status(204)
             else:
                 raise Exception("Message not deleted")
@@ -325,147 +453,870 @@ class MessageHandler(BaseHandler):
             self.write({"status": "error", "message": str(e)})
 
 
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+# Ranked results can't be paged by key; deeper pages cost more, so stop here
+MAX_SEARCH_OFFSET = 1000
+
+
+class SearchHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self):
+        """GET /api/search?q=<words>&room=<room>&limit=N&offset=M
+
+        Returns one page of the room's messages matching every word, best
+        match first, each with a highlighted snippet, plus the offset of the
+        next page.
+        """
+        try:
+            query = self.get_argument("q").strip()
+            if not query:
+                raise ValueError("q must not be empty")
+            limit = int(self.get_argument("limit", SEARCH_PAGE_SIZE))
+            if not 1 <= limit <= MAX_SEARCH_PAGE_SIZE:
+                raise ValueError(f"limit must be between 1 and {MAX_SEARCH_PAGE_SIZE}")
+            offset = int(self.get_argument("offset", 0))
+            if not 0 <= offset <= MAX_SEARCH_OFFSET:
+                raise ValueError(f"offset must be between 0 and {MAX_SEARCH_OFFSET}")
+            room = self.get_room()
+        except (ValueError, tornado.web.MissingArgumentError) as e:
+            self.set_status(400)
+            self.write({"status": "error", "message": str(e), "type": "validation_error"})
+            return
+
+        DB = self.get_db()
+        messages = await DB.search_messages(query, room=room, limit=limit, offset=offset)
+        next_offset = offset + limit if len(messages) == limit and offset + limit <= MAX_SEARCH_OFFSET else None
+        self.write({
+            "status": "success",
+            "data": {
+                "messages": [client_message(message) for message in messages],
+                "next_offset": next_offset
+            }
+        })
+
+
+def client_message(message):
+    """Copy of a message dict from the database without server-side fields"""
+    attachment = message['attachment']
+    if attachment:
+        attachment = {key: value for key, value in attachment.items() if key != 'file_path'}
+    return {**message, 'attachment': attachment}
+
+
+# Frames buffered per connection before the slow-client policy applies
+SEND_QUEUE_SIZE = 256
+# "drop" discards new frames for a full queue, "disconnect" closes the socket
+SLOW_CLIENT_POLICY = "disconnect"
+# Messages fetched per query when a resuming client is too far behind the replay buffer
+REPLAY_PAGE_SIZE = 100
+# Most messages replayed from the database; a client further behind than
+# this gets only the sync snapshot of the newest page
+REPLAY_MAX_MESSAGES = REPLAY_BUFFER_SIZE
+
+
 class WebSocketHandler(BaseHandler, tornado.websocket.WebSocketHandler):
-    clients = set()
+    # room name -> connections subscribed to it, so fan-out only touches the room
+    rooms = {}
+    # Pub/sub backbone shared with the other workers, set up by make_app
+    broker = None
+    # Recent chat messages per room, filled from the broker on every worker
+    replay_buffer = ReplayBuffer()
+    # room -> small events waiting for the next batch to compact clients
+    batches = {}
+    batch_timer = None
+    room = None
+    online = False
+    # Whether the client speaks the compact protocol (protocol.PROTOCOL_V2)
+    compact = False
+    # Inbound frame rate limit, a ratelimit.TokenBucket (None when off)
+    frames = None
+
+    def prepare(self):
+        super().prepare()
+        try:
+            self.room = self.get_room()
+            last_id = self.get_argument("last_id", None)
+            self.last_id = int(last_id) if last_id else None
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        # Decided here because compression is set up before select_subprotocol runs
+        offered = self.request.headers.get("Sec-WebSocket-Protocol", "")
+        self.compact = protocol.PROTOCOL_V2 in [name.strip() for name in offered.split(",")]
+
+    def select_subprotocol(self, subprotocols):
+        return protocol.PROTOCOL_V2 if self.compact else None
+
+    def get_compression_options(self):
+        # Deflate costs server CPU per connection; only compact clients opt in
+        if self.compact and config.WS_COMPRESSION:
+            return protocol.COMPRESSION_OPTIONS
+        return None
+
+    def encode(self, event):
+        """A frame for this client, in the encoding it negotiated"""
+        return protocol.encode(event, self.compact)
 
     async def open(self):
         if self.get_secure_cookie("user"):
-            WebSocketHandler.clients.add(self)
-            # Notify others about new connection
-            self.broadcast_presence(self.current_user, "online")
+            self.send_queue = tornado.queues.Queue(maxsize=SEND_QUEUE_SIZE)
+            self.online = True
+            if config.RATE_WS_FRAMES:
+                self.frames = ratelimit.TokenBucket(config.RATE_WS_FRAMES, config.RATE_WS_FRAMES_BURST)
+            # Subscribe first so nothing published during the replay is lost;
+            # live frames wait in the queue until the replay is written
+            WebSocketHandler.subscribe(self)
+            # Others hear about it only if this is the user's first connection;
+            # done before any await so on_close always has a connect to undo
+            self.settings['presence'].connect(self.room, self.current_user.decode('utf-8'))
+            if self.last_id is not None:
+                await self.replay(self.last_id)
+            await self.send_read_watermarks()
+            await self.send_presence()
+            tornado.ioloop.IOLoop.current().spawn_callback(self.drain_send_queue)
         else:
             self.close()
 
+    async def replay(self, last_id):
+        """Send what the client missed since message last_id, from memory if
+        the replay buffer covers it, otherwise page by page from the database"""
+        try:
+            frames = self.replay_buffer.since(self.room, last_id)
+            if frames is not None:
+                for frame in frames:
+                    await self.write_message(self.encode(json.loads(frame)) if self.compact else frame)
+                return
+
+            # Pages are collected before anything is sent, so a gap too big to
+            # replay whole isn't half sent with a hole before the snapshot
+            DB = self.get_db()
+            missed = []
+            while self.online and len(missed) <= REPLAY_MAX_MESSAGES:
+                messages = await DB.get_message(REPLAY_PAGE_SIZE, room=self.room, after=last_id)
+                missed.extend(messages)
+                if len(messages) < REPLAY_PAGE_SIZE:
+                    break
+                last_id = messages[-1]['id']
+            if len(missed) <= REPLAY_MAX_MESSAGES:
+                for message in missed:
+                    await self.write_message(self.encode(client_message(message)))
+
+            # Edits and deletions in the gap aren't in the database as events;
+            # the current state of the newest page lets the client converge
+            messages = await DB.get_message(room=self.room)
+            await self.write_message(self.encode({
+                "type": "sync",
+                "room": self.room,
+                "messages": [client_message(message) for message in messages]
+            }))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    @classmethod
+    def subscribe(cls, client):
+        cls.rooms.setdefault(client.room, set()).add(client)
+
+    @classmethod
+    def unsubscribe(cls, client):
+        subscribers = cls.rooms.get(client.room)
+        if subscribers is not None:
+            subscribers.discard(client)
+            if not subscribers:
+                del cls.rooms[client.room]
+
+    async def drain_send_queue(self):
+        """Write queued frames one at a time, waiting for each to reach the socket"""
+        while True:
+            frame = await self.send_queue.get()
+            if frame is None:
+                return
+            try:
+                await self.write_message(frame)
+            except tornado.websocket.WebSocketClosedError:
+                return
+
+    def send_frame(self, frame):
+        """Queue an encoded frame; returns False if the client can't keep up"""
+        try:
+            self.send_queue.put_nowait(frame)
+        except tornado.queues.QueueFull:
+            return False
+        # The one place deliveries are counted; batched events count once sent
+        metrics.FANOUT_FRAMES.inc()
+        return True
+
     async def on_message(self, message):
+        if self.frames is not None:
+            # Frames over the rate are dropped; a client that keeps going
+            # until it owes a whole burst is cut off
+            wait = self.frames.borrow(1)
+            if wait:
+                metrics.RATE_LIMITED.labels("frames").inc()
+                if self.frames.tokens <= -self.frames.burst:
+                    self.close(1008, "Rate limit exceeded")
+                return
         try:
             msg = json.loads(message)
             if msg.get('type') == 'typing':
-                # Handle typing indicator
-                self.broadcast_typing_status(
+                # Handle typing indicator; the aggregator sends batched snapshots
+                self.publish_typing(
                     self.current_user.decode('utf-8'),
-                    msg.get('is_typing', False)
+                    bool(msg.get('is_typing', False))
                 )
             elif msg.get('type') == 'read_receipt':
-                # Handle read receipts
-                self.broadcast_read_receipt(
-                    self.current_user.decode('utf-8'),
-                    msg.get('message_id')
-                )
+                # The client's read position; other clients get it batched
+                await self.publish_read_receipt(int(msg.get('message_id')))
             # No message creation here!
-        except json.JSONDecodeError:
+        except (json.JSONDecodeError, TypeError, ValueError):
             pass
-        except Exception as e:
-            print(f"WebSocket error: {e}")
+        except Exception:
+            log.exception("WebSocket error")
 
     def on_close(self):
-        if self in WebSocketHandler.clients:
-            WebSocketHandler.clients.remove(self)
-            # Notify others about disconnection
-            self.broadcast_presence(self.current_user, "offline")
+        if self.online:
+            self.online = False
+            WebSocketHandler.unsubscribe(self)
+            try:
+                self.send_queue.put_nowait(None)
+            except tornado.queues.QueueFull:
+                pass  # the pending write fails on the closed socket and stops the drain
+            username = self.current_user.decode('utf-8')
+            self.publish_typing(username, False)
+            # Others hear about it once the user's last connection is gone
+            self.settings['presence'].disconnect(self.room, username)
+
+    def publish_typing(self, username, is_typing):
+        # Every worker aggregates all typing updates so snapshots are complete
+        self.broker.publish("typing", utf8(json_encode([self.room, username, is_typing])))
 
     @classmethod
-    def broadcast(cls, message):
-        """More robust broadcasting"""
-        dead_clients = []
-        for client in cls.clients:
-            try:
-                client.write_message(message)
-            except tornado.websocket.WebSocketClosedError:
-                dead_clients.append(client)
-        
-        # Remove dead clients
-        for client in dead_clients:
-            cls.clients.remove(client)
+    def broadcast(cls, message, room=model.DEFAULT_ROOM):
+        """Encode the event once and publish it to the room on every worker"""
+        # The header tells the replay buffer what to keep: "m<id>" for a new
+        # message, "c" for an edit or deletion, nothing for transient events
+        if "type" not in message:
+            kind = b"m" + utf8(str(message["id"]))
+        elif message["type"] in ("message_edited", "message_deleted"):
+            kind = b"c"
+        else:
+            kind = b""
+        cls.broker.publish("events", utf8(room) + b"\n" + kind + b"\n" + utf8(json_encode(message)))
+
+    @classmethod
+    def deliver(cls, data):
+        """Broker callback for events published by any worker"""
+        room, _, data = data.partition(b"\n")
+        kind, _, frame = data.partition(b"\n")
+        room = room.decode("utf-8")
+        if kind.startswith(b"m"):
+            cls.replay_buffer.append(room, int(kind[1:]), frame)
+        elif kind == b"c":
+            cls.replay_buffer.append_change(room, frame)
+        cls.fan_out(room, frame)
+
+    @classmethod
+    def fan_out(cls, room, frame=None, event=None):
+        """Queue an event for this worker's clients in the room, given as its
+        original encoding, as the event itself or both. Each encoding is made
+        at most once; compact clients get small events in the next batch."""
+        subscribers = cls.rooms.get(room)
+        if not subscribers:
+            return
+        start = time.perf_counter()
+        batched = event is not None and event["type"] in protocol.BATCHED_TYPES
+        compact_frame = None
+        has_compact = False
+        # write_message sends bytes as-is, so no client re-serializes it
+        slow_clients = []
+        for client in subscribers:
+            if client.compact:
+                has_compact = True
+                if batched:
+                    continue
+                if compact_frame is None:
+                    compact_frame = protocol.encode(event or json.loads(frame), True)
+                client_frame = compact_frame
+            else:
+                if frame is None:
+                    frame = protocol.encode(event)
+                client_frame = frame
+            if not client.send_frame(client_frame):
+                slow_clients.append(client)
+        if batched and has_compact:
+            cls.queue_batch(room, event)
+        cls.drop_slow_clients(slow_clients)
+        metrics.FANOUT_DURATION.observe(time.perf_counter() - start)
+
+    @classmethod
+    def queue_batch(cls, room, event):
+        events = cls.batches.setdefault(room, [])
+        if event["type"] == "typing":
+            # A typing snapshot supersedes the one before it
+            events[:] = [queued for queued in events if queued["type"] != "typing"]
+        events.append(event)
+        if cls.batch_timer is None:
+            cls.batch_timer = tornado.ioloop.IOLoop.current().call_later(
+                protocol.BATCH_INTERVAL, cls.flush_batches)
+
+    @classmethod
+    def flush_batches(cls):
+        """Send each room's waiting small events to its compact clients as one frame"""
+        cls.batch_timer = None
+        batches, cls.batches = cls.batches, {}
+        for room, events in batches.items():
+            frame = protocol.encode_batch(events)
+            slow_clients = [client for client in cls.rooms.get(room, ())
+                            if client.compact and not client.send_frame(frame)]
+            cls.drop_slow_clients(slow_clients)
 
     @classmethod
-    def broadcast_typing_status(cls, username, is_typing):
-        """For real-time typing indicators"""
+    def drop_slow_clients(cls, slow_clients):
+        for client in slow_clients:
+            if SLOW_CLIENT_POLICY == "drop":
+                metrics.DROPPED_FRAMES.inc()
+            else:
+                # on_close runs later; stop feeding the client until then
+                cls.unsubscribe(client)
+                client.close(1013, "Client too slow")
+                metrics.SLOW_CLIENT_DISCONNECTS.inc()
+
+    @classmethod
+    def broadcast_edit(cls, message):
+        """Delta for an edited message; clients keep the highest revision"""
         cls.broadcast({
+            "type": "message_edited",
+            "id": message['id'],
+            "room": message['room'],
+            "revision": message['revision'],
+            "content": message['content'],
+            "has_attachment": message['has_attachment'],
+            "attachment": client_message(message)['attachment']
+        }, message['room'])
+
+    @classmethod
+    def broadcast_delete(cls, message_id, room, revision):
+        cls.broadcast({
+            "type": "message_deleted",
+            "id": message_id,
+            "room": room,
+            "revision": revision
+        }, room)
+
+    @classmethod
+    def broadcast_typing_snapshot(cls, room, usernames):
+        """For real-time typing indicators: everyone currently typing in the room"""
+        # Each worker aggregates every update itself, so only send locally
+        cls.fan_out(room, event={
             "type": "typing",
-            "username": username,
-            "is_typing": is_typing
+            "room": room,
+            "users": usernames
         })
 
+    async def send_presence(self):
+        """Everyone online in the room, once per connection"""
+        try:
+            await self.write_message(self.encode({
+                "type": "presence_snapshot",
+                "room": self.room,
+                "users": self.settings['presence'].snapshot(self.room)
+            }))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
     @classmethod
-    def broadcast_presence(cls, username, status):
+    def broadcast_presence(cls, room, username, status):
         """For online/offline status"""
-        cls.broadcast({
+        # Each worker tracks every worker's connections itself, so only send locally
+        cls.fan_out(room, event={
             "type": "presence",
+            "room": room,
             "username": username,
             "status": status
         })
 
+    async def send_read_watermarks(self):
+        """Everyone's read position in the room, once per connection"""
+        stored = await self.get_db().get_read_watermarks(self.room)
+        watermarks = self.settings['read_state'].snapshot(self.room, stored)
+        try:
+            await self.write_message(self.encode(self.read_watermarks_event(self.room, watermarks, snapshot=True)))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    async def publish_read_receipt(self, message_id):
+        username = self.current_user.decode('utf-8')
+        read_state = self.settings['read_state']
+        # Watermarks only move forward; stale and repeated receipts stop here
+        if message_id <= read_state.get(self.room, username):
+            return
+        # Nor can they pass the room's newest message. Usually the replay
+        # buffer has seen it; otherwise the (cached) newest message decides.
+        if message_id > self.replay_buffer.newest.get(self.room, 0):
+            newest = await self.get_db().get_message(1, room=self.room)
+            if not newest or message_id > newest[0]['id']:
+                return
+        read_state.record(self.room, await self.get_current_user_id(), message_id)
+        self.broker.publish("receipts", utf8(json_encode([self.room, username, message_id])))
+
+    @staticmethod
+    def read_watermarks_event(room, watermarks, snapshot=False):
+        """For read receipts: {username: last read message id}, either the
+        users whose position changed or, as a snapshot, everyone's"""
+        return {
+            "type": "read_receipts",
+            "room": room,
+            "watermarks": watermarks,
+            "snapshot": snapshot
+        }
+
     @classmethod
-    def broadcast_read_receipt(cls, username, message_id):
-        """For message read receipts"""
-        cls.broadcast({
-            "type": "read_receipt",
-            "username": username,
-            "message_id": message_id,
-            "timestamp": datetime.now().isoformat()
-        })
+    def broadcast_read_watermarks(cls, room, watermarks):
+        # Each worker coalesces every receipt itself, so only send locally
+        cls.fan_out(room, event=cls.read_watermarks_event(room, watermarks))
 
 
  
+@tornado.web.stream_request_body
+class UploadHandler(BaseHandler):
+    """POST /api/uploads?filename=<name> with the raw file as the request body.
+
+    The body is hashed and written to a temp file chunk by chunk, so memory
+    stays at a few chunks whatever the file size. The finished file is moved
+    into upload_dir under its SHA-256 name and the new attachment id returned
+    for use as attachment_id on /api/messages.
+    """
+
+    retry_after = None
+
+    def prepare(self):
+        super().prepare()
+        self.temp_path = None
+        if not self.current_user:
+            raise tornado.web.HTTPError(403)
+
+        # Uploads over the byte rate are slowed down in data_received; only
+        # refuse once the user's earlier uploads are already that far ahead
+        wait = self.settings['rate_limits']['uploads'].debt(self.current_user)
+        if wait > config.UPLOAD_MAX_WAIT:
+            metrics.RATE_LIMITED.labels("uploads").inc()
+            self.retry_after = ratelimit.retry_after(wait)
+            raise tornado.web.HTTPError(429, f"Too many uploads, try again in {self.retry_after} s")
+
+        try:
+            self.file_name = os.path.basename(self.get_argument("filename"))
+            self.mime_type, self.file_ext, self.max_size = files.check_file(self.file_name)
+        except (ValueError, tornado.web.MissingArgumentError) as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+        # Refuse oversized uploads before reading any of the body
+        declared = int(self.request.headers.get("Content-Length", 0))
+        if declared > self.max_size:
+            raise tornado.web.HTTPError(413, f"File exceeds maximum size for {self.mime_type.split('/')[0]}")
+        self.request.connection.set_max_body_size(self.max_size)
+
+        upload_dir = self.settings['upload_dir']
+        os.makedirs(upload_dir, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=upload_dir, prefix=".upload-", suffix=".part")
+        self.temp_file = os.fdopen(fd, 'wb')
+        self.hasher = hashlib.sha256()
+        self.file_size = 0
+
+    async def data_received(self, chunk):
+        self.file_size += len(chunk)
+        if self.file_size > self.max_size:
+            raise tornado.web.HTTPError(413)
+        # Reading the next chunk waits until the user is back within the rate
+        wait = self.settings['rate_limits']['uploads'].borrow(self.current_user, len(chunk))
+        if wait:
+            await tornado.gen.sleep(wait)
+        # Hashing and writing release the GIL; reading waits until they're done
+        await tornado.ioloop.IOLoop.current().run_in_executor(None, self.write_chunk, chunk)
+
+    def write_chunk(self, chunk):
+        self.hasher.update(chunk)
+        self.temp_file.write(chunk)
+
+    async def post(self):
+        self.temp_file.close()
+        file_hash = self.hasher.hexdigest()
+        file_path = os.path.join(self.settings['upload_dir'], f"{file_hash}{self.file_ext}")
+        # Identical content is stored once: the database layer moves the temp
+        # file into place only when the blob doesn't exist yet
+        temp_path, self.temp_path = self.temp_path, None
+        attachment_id = await self.get_db().save_attachment(
+            user_id=await self.get_current_user_id(),
+            file_name=self.file_name,
+            file_path=file_path,
+            file_size=self.file_size,
+            mime_type=self.mime_type,
+            hash_sha256=file_hash,
+            temp_path=temp_path
+        )
+        if not attachment_id:
+            raise tornado.web.HTTPError(500)
+        metrics.UPLOAD_BYTES.inc(self.file_size)
+        self.settings['thumbnails'].submit(file_hash, file_path, self.mime_type)
+
+        self.set_status(201)
+        self.write({
+            "status": "success",
+            "data": {
+                "id": attachment_id,
+                "file_name": self.file_name,
+                "mime_type": self.mime_type,
+                "file_size": self.file_size
+            }
+        })
+
+    def write_error(self, status_code, **kwargs):
+        message = self._reason
+        if "exc_info" in kwargs and isinstance(kwargs["exc_info"][1], tornado.web.HTTPError):
+            message = kwargs["exc_info"][1].log_message or message
+        if status_code == 429:
+            self.set_header("Retry-After", self.retry_after)
+            self.write({"status": "error", "message": message, "type": "rate_limited"})
+            return
+        self.write({"status": "error", "message": message, "type": "validation_error"})
+
+    def on_finish(self):
+        self.discard_temp_file()
+
+    def on_connection_close(self):
+        self.discard_temp_file()
+
+    def discard_temp_file(self):
+        if getattr(self, "temp_path", None):
+            self.temp_file.close()
+            try:
+                os.remove(self.temp_path)
+            except FileNotFoundError:
+                pass
+            self.temp_path = None
+
+
+# Bytes per read when streaming an attachment
+ATTACHMENT_CHUNK_SIZE = 512 * 1024
+# A single byte range: "bytes=first-last", "bytes=first-" or "bytes=-suffix"
+BYTE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_byte_range(header, size):
+    """(start, end) of a Range header against a file of `size` bytes, end
+    exclusive and clipped to the file; start >= end when unsatisfiable. None
+    for anything but one well-formed byte range, which is served whole."""
+    match = BYTE_RANGE.match(header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # The last `last` bytes; none of them is unsatisfiable
+        return (max(size - int(last), 0), size) if int(last) else (size, size)
+    start = int(first)
+    if last != "" and int(last) < start:
+        return None
+    return start, size if last == "" else min(int(last) + 1, size)
+
+
 class AttachmentHandler(BaseHandler):
+    """Serves attachment files with their SHA-256 as a strong ETag.
+
+    The bytes behind an attachment id never change, so browsers may cache them
+    for good and revalidate with If-None-Match; Range requests let media
+    elements seek without downloading the whole file.
+    """
+
+    async def get_attachment(self, attachment_id):
+        DB = self.get_db()
+        attachment = await DB.get_attachment(attachment_id)
+        
+        # Verify the requesting user has access to this file
+        current_user_id = await self.get_current_user_id()
+        
+        if not attachment or attachment[3] != current_user_id:
+            raise tornado.web.HTTPError(404)
+        return attachment
+
+    @tornado.web.authenticated
     async def get(self, attachment_id):
+        await self.serve(attachment_id)
+
+    @tornado.web.authenticated
+    async def head(self, attachment_id):
+        await self.serve(attachment_id, include_body=False)
+
+    async def serve(self, attachment_id, include_body=True):
+        file_name, file_path, mime_type, _, file_size, file_hash = await self.get_attachment(attachment_id)
+        self.set_header('Content-Disposition', 
+                      f'attachment; filename="{file_name}"')
+        await self.send_file(file_path, mime_type, file_hash, include_body)
+
+    async def send_file(self, file_path, mime_type, etag, include_body=True):
+        self.set_header("Etag", f'"{etag}"')
+        self.set_header("Cache-Control", "private, max-age=31536000, immutable")
+        self.set_header("Accept-Ranges", "bytes")
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
         try:
-            DB = self.get_db()
-            attachment = DB.cursor.execute("""
-                SELECT file_name, file_path, mime_type, user_id 
-                FROM attachments WHERE id = ?
-            """, (attachment_id,)).fetchone()
-            
-            # Verify the requesting user has access to this file
-            current_user = self.get_current_user().decode('utf-8')
-            current_user_id = DB.get_user(current_user)[0][0]
-            
-            if not attachment or attachment[3] != current_user_id:
-                raise tornado.web.HTTPError(404)
-            
-            # Stream the file instead of loading fully in memory
-            self.set_header('Content-Type', attachment[2])
-            self.set_header('Content-Disposition', 
-                          f'attachment; filename="{attachment[0]}"')
-            
-            with open(attachment[1], 'rb') as f:
-                while True:
-                    chunk = f.read(4096)  # 4KB chunks
-                    if not chunk:
-                        break
-                    self.write(chunk)
-                    await self.flush()
-        except Exception as e:
-            print(f"Error!{e}")
-            
-            self.finish()
+            f = open(file_path, 'rb')
+        except FileNotFoundError:
+            raise tornado.web.HTTPError(404)
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            start, end = 0, size
+            range_header = self.request.headers.get("Range")
+            request_range = parse_byte_range(range_header, size) if range_header else None
+            if request_range:
+                start, end = request_range
+                if start >= end:
+                    self.set_status(416)
+                    self.set_header("Content-Range", f"bytes */{size}")
+                    return
+                self.set_status(206)
+                self.set_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+
+            self.set_header('Content-Type', mime_type)
+            self.set_header("Content-Length", end - start)
+            if not include_body:
+                return
 
-def make_app():
+            # Large reads off the IOLoop, flushed one at a time so a slow
+            # client never has more than a chunk buffered
+            loop = tornado.ioloop.IOLoop.current()
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = await loop.run_in_executor(None, f.read, min(ATTACHMENT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self.write(chunk)
+                await self.flush()
+
+
+class ThumbnailHandler(AttachmentHandler):
+    """GET /attachments/<id>/thumb: downscaled image or video poster frame.
+
+    Thumbnails are made in the background after upload; one that isn't ready
+    yet is queued and the client sent to the original in the meantime.
+    """
+
+    async def serve(self, attachment_id, include_body=True):
+        _, file_path, mime_type, _, _, file_hash = await self.get_attachment(attachment_id)
+        thumb_path = thumbnails.thumbnail_path(file_path, file_hash)
+        if os.path.exists(thumb_path):
+            await self.send_file(thumb_path, "image/jpeg", f"{file_hash}-thumb", include_body)
+            return
+
+        # Known failures go straight to the original without queueing again
+        pipeline = self.settings['thumbnails']
+        if not pipeline.has_failed(file_hash):
+            pipeline.submit(file_hash, file_path, mime_type)
+        if not mime_type.startswith("image/"):
+            raise tornado.web.HTTPError(404)
+        self.set_header("Cache-Control", "no-store")
+        self.redirect(f"/attachments/{attachment_id}")
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """GET /metrics: this process's metrics in the Prometheus text format.
+    With a token, only for requests sending it as a bearer token."""
+
+    def initialize(self, token=None):
+        self.token = token
+
+    def get(self):
+        if self.token is not None:
+            scheme, _, credentials = self.request.headers.get("Authorization", "").partition(" ")
+            if scheme.lower() != "bearer" or not hmac.compare_digest(utf8(credentials), utf8(self.token)):
+                self.set_header("WWW-Authenticate", "Bearer")
+                raise tornado.web.HTTPError(401)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.REGISTRY.render())
+
+
+def log_request(handler):
+    """Application log_function: request metrics and the access log"""
+    request = handler.request
+    status = handler.get_status()
+    duration = request.request_time()
+    name = type(handler).__name__
+    # Clients choose the method string; keep the label set bounded
+    method = request.method if request.method in handler.SUPPORTED_METHODS else "other"
+    metrics.HTTP_REQUEST_DURATION.labels(name, method).observe(duration)
+    metrics.HTTP_RESPONSES.labels(name, method, str(status)).inc()
+
+    if status < 400:
+        level = logging.INFO
+    elif status < 500:
+        level = logging.WARNING
+    else:
+        level = logging.ERROR
+    if access_log.isEnabledFor(level):
+        # The path only: query strings may carry search terms and file names
+        access_log.log(level, "%s %s %s", status, request.method, request.path, extra={
+            "status": status,
+            "method": request.method,
+            "path": request.path,
+            "handler": name,
+            "duration_ms": round(duration * 1000, 3),
+            "remote_ip": request.remote_ip
+        })
+
+def make_app(db_path=model.DB_PATH, cookie_secret=config.COOKIE_SECRET, broker_url=config.BROKER_URL):
     # Initialize mimetypes
     mimetypes.init()
 
+    # One database layer for the whole application; schema setup happens here
+    # once and queries run on its thread pool instead of the IOLoop
+    db = async_db.AsyncChatDB(db_path, hasher=passwords.make_hasher(config.PASSWORD_HASHER, config.PASSWORD_COST),
+                              archive_dir=config.ARCHIVE_DIR)
+
+    # Writes made by other workers; this worker's own already updated its cache
+    def refresh_message(data):
+        pid, _, message_id = data.partition(b":")
+        if int(pid) != os.getpid():
+            tornado.ioloop.IOLoop.current().spawn_callback(db.refresh_message, int(message_id))
+
+    # Broadcasts, typing updates, read receipts and presence go through the
+    # broker so they reach clients connected to any worker
+    typing = TypingAggregator(WebSocketHandler.broadcast_typing_snapshot)
+    events = broker.make_broker(broker_url)
+    events.subscribe("events", WebSocketHandler.deliver)
+    events.subscribe("typing", lambda data: typing.update(*json.loads(data)))
+    read_state = ReadWatermarks(WebSocketHandler.broadcast_read_watermarks, db.save_read_watermarks)
+    events.subscribe("receipts", lambda data: read_state.update(*json.loads(data)))
+    events.subscribe("messages", refresh_message)
+    presence = PresenceRegistry(
+        WebSocketHandler.broadcast_presence,
+        lambda room, username, present: events.publish(
+            "presence", utf8(json_encode([room, username, os.getpid(), present]))))
+    events.subscribe("presence", lambda data: presence.update(*json.loads(data)))
+    # Rooms whose oldest messages another worker (or this one) archived
+    def forget_archived(data):
+        for room in json.loads(data):
+            db.recent.forget(room)
+        tornado.ioloop.IOLoop.current().spawn_callback(db.load_archive_ranges)
+    events.subscribe("archived", forget_archived)
+    events.start()
+    WebSocketHandler.broker = events
+
+    # Messages up to the current newest one are only in the database; the
+    # replay buffer covers what this worker sees from here on
+    replay_buffer = WebSocketHandler.replay_buffer = ReplayBuffer()
+    async def start_replay_buffer():
+        last_id = await db.get_last_message_id()
+        if last_id is not None:
+            replay_buffer.start_after(last_id)
+    tornado.ioloop.IOLoop.current().spawn_callback(start_replay_buffer)
+
+    # Unreferenced attachment blobs are removed in the background
+    async def collect_garbage():
+        removed, freed = await db.collect_garbage(config.BLOB_GC_GRACE)
+        if removed:
+            log.info("Removed %s unreferenced blobs (%s bytes)", removed, freed)
+
+    # History pages continue into the archive files past these ids
+    tornado.ioloop.IOLoop.current().spawn_callback(db.load_archive_ranges)
+
+    # Blob GC, retention and compaction run in one worker only; each step is
+    # a short write on the database thread, so the loop keeps serving in between
+    async def maintain():
+        moved, rooms = 0, set()
+        while True:
+            batch, batch_rooms = await db.archive_messages(config.RETENTION_DAYS, config.RETENTION_ROWS)
+            moved += batch
+            rooms.update(batch_rooms)
+            if batch < model.ARCHIVE_BATCH:
+                break
+        if moved:
+            events.publish("archived", utf8(json_encode(sorted(rooms))))
+            log.info("Archived %s messages from %s rooms", moved, len(rooms))
+        free = await db.incremental_vacuum()
+        while free:
+            left = await db.incremental_vacuum()
+            if left >= free:
+                break
+            free = left
+    if tornado.process.task_id() in (None, 0):
+        tornado.ioloop.PeriodicCallback(collect_garbage, config.BLOB_GC_INTERVAL * 1000).start()
+        tornado.ioloop.PeriodicCallback(maintain, config.MAINTENANCE_INTERVAL * 1000).start()
+        tornado.ioloop.PeriodicCallback(db.analyze, config.ANALYZE_INTERVAL * 1000).start()
+
+    # Per-user limits on what reaches the database writer, admitting less
+    # for everyone while its writes queue up
+    pressure = ratelimit.Backpressure(lambda: db.write_latency, config.BACKPRESSURE_LATENCY)
+    rate_limits = {
+        "posts": ratelimit.RateLimiter(config.RATE_POSTS, config.RATE_POSTS_BURST, pressure),
+        "uploads": ratelimit.RateLimiter(config.RATE_UPLOAD_BYTES, config.RATE_UPLOAD_BYTES, pressure)
+    }
+
+    # Metrics read from existing state when /metrics is rendered
+    metrics.WEBSOCKET_CONNECTIONS.set_function(
+        lambda: sum(len(clients) for clients in WebSocketHandler.rooms.values()))
+    metrics.CACHE_HITS.set_function(
+        lambda: {("users",): db.user_ids.hits, ("recent_messages",): db.recent.hits})
+    metrics.CACHE_MISSES.set_function(
+        lambda: {("users",): db.user_ids.misses, ("recent_messages",): db.recent.misses})
+    metrics.DB_WRITE_LATENCY.set_function(lambda: db.write_latency)
+    metrics.BACKPRESSURE_SCALE.set_function(pressure)
+    tornado.ioloop.IOLoop.current().spawn_callback(metrics.monitor_ioloop_lag)
+
+    handlers = [
+        (r"/", MainHandler), 
+        (r"/login", LoginHandler),
+        (r"/signup", SignupHandler),
+        (r"/logout", LogoutHandler),
+        (r"/chat", MessageHandler),
+        (r"/ws", WebSocketHandler), 
+        (r"/api/messages/([0-9]+)", MessageHandler),
+        (r"/api/messages", MessageHandler),
+        (r"/api/search", SearchHandler),
+        (r"/api/uploads", UploadHandler),
+        (r"/attachments/([0-9]+)", AttachmentHandler),
+        (r"/attachments/([0-9]+)/thumb", ThumbnailHandler)
+    ]
+    # Only behind a token on the public port, see config.METRICS_TOKEN
+    if config.METRICS_TOKEN:
+        handlers.append((r"/metrics", MetricsHandler, {"token": config.METRICS_TOKEN}))
+
     return tornado.web.Application(
-        [
-            (r"/", MainHandler), 
-            (r"/login", LoginHandler),
-            (r"/signup", SignupHandler),
-            (r"/logout", LogoutHandler),
-            (r"/chat", MessageHandler),
-            (r"/ws", WebSocketHandler), 
-            (r"/api/messages/([0-9]+)", MessageHandler),
-            (r"/api/messages", MessageHandler),
-            (r"/attachments/([0-9]+)", AttachmentHandler)
-        ],
-        cookie_secret=str(random.randint(100000,999999)) + str(random.randint(100000,999999)),
+        handlers,
+        cookie_secret=cookie_secret,
         login_url="/login", 
         template_path="templates",
         static_path="static",
-        upload_dir="uploads"
+        upload_dir="uploads",
+        db=db,
+        typing=typing,
+        read_state=read_state,
+        presence=presence,
+        rate_limits=rate_limits,
+        broker=events,
+        thumbnails=thumbnails.ThumbnailPipeline(),
+        log_function=log_request
     )
 
 if __name__ == "__main__":
+    logs.setup(config.LOG_LEVEL, config.LOG_FORMAT)
+    port = config.PORT
+    sockets = tornado.netutil.bind_sockets(port)
+    if config.WORKERS != 1:
+        if config.BROKER_URL == "memory":
+            raise SystemExit("CHAT_BROKER must be a shared broker when CHAT_WORKERS != 1")
+        # Run migrations once here instead of racing in every worker
+        model.chat_db().close()
+        if config.BROKER_URL.startswith("unix:"):
+            hub_path = config.BROKER_URL[len("unix:"):]
+            multiprocessing.Process(target=broker.run_hub, args=(hub_path,), daemon=True).start()
+        tornado.process.fork_processes(config.WORKERS)
     app = make_app()
-    port = 8989  
-    print(f"Starting server on port {port}")
-    app.listen(port)
+    log.info("Starting server on port %s", port)
+    server = tornado.httpserver.HTTPServer(app, max_body_size=files.MAX_FORM_BODY_SIZE)
+    server.add_sockets(sockets)
+    if config.METRICS_PORT:
+        metrics_port = config.METRICS_PORT + (tornado.process.task_id() or 0)
+        tornado.web.Application([(r"/metrics", MetricsHandler)]).listen(metrics_port, address=config.METRICS_ADDRESS)
+        log.info("Serving metrics on %s:%s", config.METRICS_ADDRESS, metrics_port)
     tornado.ioloop.IOLoop.current().start()
\ No newline at end of file
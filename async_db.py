@@ -0,0 +1,257 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+from cache import LRUCache, RecentMessages
+from passwords import PasswordHasher
+import metrics
+import model
+
+# Message inserts are grouped into one transaction per batch: a batch is
+# committed once it holds GROUP_COMMIT_SIZE rows or GROUP_COMMIT_DELAY
+# seconds after its first row, whichever comes first
+GROUP_COMMIT_SIZE = 64
+GROUP_COMMIT_DELAY = 0.002
+# Weight of the newest write in write_latency's moving average
+WRITE_LATENCY_WEIGHT = 0.1
+
+
+class AsyncChatDB:
+    """Awaitable facade over model.chat_db.
+
+    Queries run on worker threads so a slow commit or a lock wait never blocks
+    the IOLoop. Reads use a small pool where every thread keeps its own
+    connection (WAL lets them run next to the writer); writes go through one
+    dedicated thread so they stay serialized.
+    """
+
+    def __init__(self, path=model.DB_PATH, readers=4, user_cache_size=10000, hasher=None, archive_dir=None):
+        self.path = path
+        self.archive_dir = archive_dir
+        # Password hashing runs on its own threads, never on the database's
+        self.passwords = PasswordHasher(hasher)
+        # username -> user id, so handlers don't query users on every request
+        self.user_ids = LRUCache(user_cache_size)
+        # Newest messages per room; writes made through this object keep it
+        # current, other processes' writes arrive through refresh_message
+        self.recent = RecentMessages()
+        # room -> smallest archived message id, for paging past the live rows
+        self.archived_rooms = {}
+        self._local = threading.local()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        # (row, future) pairs waiting for the next group commit
+        self._pending_messages = []
+        self._commit_timer = None
+        # Moving average of seconds from submitting a write to its result,
+        # queueing behind other writes included; the backpressure signal
+        self.write_latency = 0.0
+        # The writer connection runs the migrations before any reader opens
+        self._writer.submit(self._connection, True).result()
+
+    def _connection(self, migrate=False):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = model.chat_db(self.path, migrate=migrate, archive_dir=self.archive_dir)
+        return db
+
+    def _run(self, executor, method, *args, **kwargs):
+        def call():
+            start = time.perf_counter()
+            try:
+                return getattr(self._connection(), method)(*args, **kwargs)
+            except Exception:
+                metrics.DB_QUERY_ERRORS.labels(method).inc()
+                raise
+            finally:
+                metrics.DB_QUERY_DURATION.labels(method).observe(time.perf_counter() - start)
+        return IOLoop.current().run_in_executor(executor, call)
+
+    def _read(self, method, *args, **kwargs):
+        return self._run(self._readers, method, *args, **kwargs)
+
+    def _write(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        future = self._run(self._writer, method, *args, **kwargs)
+        future.add_done_callback(lambda _: self._observe_write(time.perf_counter() - start))
+        return future
+
+    def _observe_write(self, seconds):
+        self.write_latency += (seconds - self.write_latency) * WRITE_LATENCY_WEIGHT
+
+    # Reads
+
+    async def authenticate_user(self, username, password):
+        """[(id, username)] if the password matches, else []; a hash made
+        with an outdated hasher or cost is replaced on the way"""
+        user = await self._read("get_credentials", username)
+        if user is None:
+            await self.passwords.verify_unknown(password)
+            return []
+        user_id, username, hashed_password = user
+        matches, new_hash = await self.passwords.verify(password, hashed_password)
+        if not matches:
+            return []
+        if new_hash is not None:
+            await self._write("set_password", user_id, new_hash)
+        self.user_ids.set(username, user_id)
+        return [(user_id, username)]
+
+    def get_user(self, username):
+        return self._read("get_user", username)
+
+    async def get_user_id(self, username):
+        """Cached username -> id lookup; returns None for unknown users"""
+        user_id = self.user_ids.get(username)
+        if user_id is None:
+            user = await self.get_user(username)
+            if not user:
+                return None
+            user_id = user[0][0]
+            self.user_ids.set(username, user_id)
+        return user_id
+
+    def get_message_by_id(self, message_id):
+        return self._read("get_message_by_id", message_id)
+
+    async def get_message(self, limit=100, before=None, before_time=None, room=model.DEFAULT_ROOM, after=None):
+        """model.chat_db.get_message, answered from the recent-messages cache
+        when the page lies within it; the returned dicts are read-only. Id
+        based pages continue into the archive once the live rows run out."""
+        if before_time is not None or after is not None:
+            return await self._read("get_message", limit, before, before_time, room, after)
+
+        messages = self.recent.get(room, limit, before)
+        if messages is None:
+            if before is not None:
+                messages = await self._read("get_message", limit, before, None, room)
+            else:
+                # Fetch the room's whole window so the following pages hit as well
+                fetch = max(limit, self.recent.per_room)
+                generation = self.recent.generation
+                messages = await self._read("get_message", fetch, None, None, room)
+                self.recent.load(room, messages, len(messages) < fetch, generation)
+                messages = messages[:limit]
+
+        oldest = messages[-1]['id'] if messages else before
+        if len(messages) < limit and room in self.archived_rooms and (
+                oldest is None or oldest > self.archived_rooms[room]):
+            messages = messages + await self._read("get_archived_messages", limit - len(messages), oldest, room)
+        return messages
+
+    def get_last_message_id(self):
+        return self._read("get_last_message_id")
+
+    async def get_message_detail(self, message_id):
+        message = self.recent.find(message_id)
+        if message is None:
+            message = await self._read("get_message_detail", message_id)
+        return message
+
+    def get_read_watermarks(self, room=model.DEFAULT_ROOM):
+        return self._read("get_read_watermarks", room)
+
+    async def load_archive_ranges(self):
+        """Call at startup and whenever messages were archived"""
+        self.archived_rooms = await self._read("get_archive_ranges")
+
+    def search_messages(self, query, room=model.DEFAULT_ROOM, limit=20, offset=0):
+        return self._read("search_messages", query, room, limit, offset)
+
+    def get_attachment(self, attachment_id):
+        return self._read("get_attachment", attachment_id)
+
+    # Writes
+
+    async def create_user(self, username, password):
+        hashed_password = await self.passwords.hash(password)
+        created = await self._write("create_user", username, hashed_password)
+        if created:
+            self.invalidate_user(username)
+        return created
+
+    def invalidate_user(self, username):
+        """Call whenever a user row is created, renamed or removed"""
+        self.user_ids.invalidate(username)
+
+    def save_message(self, user_id, content, timestamp=None, attachment_id=None, room=model.DEFAULT_ROOM):
+        """Queue the message for the next group commit; resolves to its id
+        (False if it couldn't be saved) once the batch is committed"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending_messages.append(((user_id, content, timestamp, attachment_id, room), future))
+        if len(self._pending_messages) >= GROUP_COMMIT_SIZE:
+            self._flush_messages()
+        elif self._commit_timer is None:
+            self._commit_timer = IOLoop.current().call_later(GROUP_COMMIT_DELAY, self._flush_messages)
+        return future
+
+    def _flush_messages(self):
+        if self._commit_timer is not None:
+            IOLoop.current().remove_timeout(self._commit_timer)
+            self._commit_timer = None
+        batch, self._pending_messages = self._pending_messages, []
+        if batch:
+            IOLoop.current().spawn_callback(self._commit_messages, batch)
+
+    async def _commit_messages(self, batch):
+        # Batches queue up behind each other on the writer thread, so the
+        # next one fills while this one commits. The writer hands back the
+        # saved rows too, so nothing else is awaited here: batches resolve in
+        # commit order and handlers broadcast their ids in that order.
+        try:
+            message_ids, messages = await self._write("save_messages_with_details", [row for row, _ in batch])
+            for message in messages:
+                self.recent.add(message)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), message_id in zip(batch, message_ids):
+            if not future.done():
+                future.set_result(message_id)
+
+    def save_attachment(self, user_id, file_name, file_path, file_size, mime_type, hash_sha256, temp_path=None):
+        return self._write("save_attachment", user_id, file_name, file_path,
+                           file_size, mime_type, hash_sha256, temp_path)
+
+    async def delete_message(self, message_id):
+        deleted = await self._write("delete_message", message_id)
+        if deleted:
+            self.recent.remove(int(message_id))
+        return deleted
+
+    async def edit_message(self, message_id, new_content, new_attachment=None, new_attachment_id=None):
+        edited = await self._write("edit_message", message_id, new_content, new_attachment, new_attachment_id)
+        if edited:
+            await self.refresh_message(int(message_id))
+        return edited
+
+    async def refresh_message(self, message_id):
+        """Bring the cached copy of a message in line with the database"""
+        message = await self._read("get_message_detail", message_id)
+        if message:
+            self.recent.add(message)
+        else:
+            self.recent.remove(message_id)
+
+    def save_read_watermarks(self, rows):
+        return self._write("save_read_watermarks", rows)
+
+    def collect_garbage(self, grace_seconds=600):
+        return self._write("collect_garbage", grace_seconds)
+
+    def archive_messages(self, max_age_days=0, max_rows=0):
+        return self._write("archive_messages", max_age_days, max_rows)
+
+    def incremental_vacuum(self):
+        return self._write("incremental_vacuum")
+
+    def analyze(self):
+        return self._write("analyze")
+
+    def close(self):
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self.passwords.close()
@@ -0,0 +1,296 @@
+"""Offline load test for the chat server.
+
+Starts make_app() in this process on a temporary database and upload
+directory, then drives it over real HTTP and WebSocket connections:
+
+  1. `--subscribers` WebSocket clients join the room
+  2. `--posters` clients post `--messages` messages each, concurrently;
+     every delivery to every subscriber is timed from just before its POST
+  3. `--uploads` files are streamed to /api/uploads and posted as attachments
+  4. `--pages` history pages are read through /api/messages?before=
+
+Results (throughput, p50/p99 latencies) go to stdout as JSON, progress and
+a summary to stderr, so runs can be saved and compared:
+
+    python benchmark.py > before.json
+    python benchmark.py --baseline before.json > after.json
+
+Clients and server share one IOLoop, so absolute numbers include the
+clients' own overhead; compare runs made with the same options.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import urllib.parse
+from datetime import datetime
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.websocket import websocket_connect
+
+import app as chat_app
+import config
+import files
+
+PASSWORD = "Bench1!pass"
+ROOM = "bench"
+# Seconds to wait for the last deliveries after the last post returned
+DELIVERY_TIMEOUT = 30
+HISTORY_PAGE_SIZE = 50
+UPLOAD_SIZE = 16 * 1024
+
+
+def log(text):
+    print(text, file=sys.stderr, flush=True)
+
+
+def summarize(samples):
+    """Latency summary in milliseconds (nearest-rank percentiles)"""
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    def percentile(p):
+        return round(samples[max(0, int(len(samples) * p / 100 + 0.5) - 1)] * 1000, 3)
+    return {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "p50_ms": percentile(50),
+        "p99_ms": percentile(99),
+        "max_ms": round(samples[-1] * 1000, 3)
+    }
+
+
+class Benchmark:
+
+    def __init__(self, options, workdir):
+        self.options = options
+        self.workdir = workdir
+        self.client = AsyncHTTPClient()
+        # message content -> time its POST was started
+        self.sent_at = {}
+        self.delivery_latencies = []
+        self.last_delivery = None
+        self.all_delivered = asyncio.Event()
+
+    async def start(self):
+        # This measures the server's throughput, not its rate limits
+        config.RATE_POSTS = config.RATE_UPLOAD_BYTES = config.RATE_WS_FRAMES = 0
+        self.application = chat_app.make_app(
+            db_path=os.path.join(self.workdir, "bench.db"),
+            cookie_secret="benchmark"
+        )
+        self.application.settings['upload_dir'] = os.path.join(self.workdir, "uploads")
+        self.server = self.application.listen(0, address="127.0.0.1", max_body_size=files.MAX_FORM_BODY_SIZE)
+        port = next(iter(self.server._sockets.values())).getsockname()[1]
+        self.base = f"http://127.0.0.1:{port}"
+        self.ws_url = f"ws://127.0.0.1:{port}/ws?room={ROOM}"
+
+    async def stop(self):
+        self.server.stop()
+        await self.server.close_all_connections()
+        self.application.settings['db'].close()
+
+    async def fetch(self, path, cookie, **kwargs):
+        headers = {"Cookie": cookie, **kwargs.pop("headers", {})}
+        return await self.client.fetch(self.base + path, headers=headers,
+                                       follow_redirects=False, raise_error=False, **kwargs)
+
+    async def login(self, username):
+        body = urllib.parse.urlencode({"username": username, "password": PASSWORD})
+        await self.fetch("/signup", "", method="POST", body=body)
+        response = await self.fetch("/login", "", method="POST", body=body)
+        cookie = "; ".join(header.split(";")[0] for header in response.headers.get_list("Set-Cookie"))
+        if "user=" not in cookie:
+            raise RuntimeError(f"Could not log in as {username}")
+        return cookie
+
+    def on_frame(self, frame):
+        if frame is None:
+            return
+        received = time.perf_counter()
+        message = json.loads(frame)
+        if "type" in message:
+            return
+        sent = self.sent_at.get(message.get("content"))
+        if sent is not None:
+            self.delivery_latencies.append(received - sent)
+            self.last_delivery = received
+            if len(self.delivery_latencies) >= self.expected_deliveries:
+                self.all_delivered.set()
+
+    async def post(self, cookie, content, attachment_id=None):
+        arguments = {"content": content, "room": ROOM}
+        if attachment_id is not None:
+            arguments["attachment_id"] = attachment_id
+        started = time.perf_counter()
+        self.sent_at[content] = started
+        response = await self.fetch("/api/messages", cookie, method="POST",
+                                    body=urllib.parse.urlencode(arguments))
+        if response.code != 201:
+            raise RuntimeError(f"POST /api/messages returned {response.code}")
+        return time.perf_counter() - started
+
+    async def run_posts(self):
+        options = self.options
+        cookies = await asyncio.gather(*[self.login(f"poster{i}") for i in range(options.posters)])
+        subscriber = await self.login("subscriber")
+        sockets = [await websocket_connect(HTTPRequest(self.ws_url, headers={"Cookie": subscriber}),
+                                           on_message_callback=self.on_frame)
+                   for _ in range(options.subscribers)]
+        log(f"{len(sockets)} subscribers connected, {options.posters} posters logged in")
+
+        self.expected_deliveries = options.subscribers * options.posters * options.messages
+        post_latencies = []
+
+        async def poster(index, cookie):
+            for i in range(options.messages):
+                post_latencies.append(await self.post(cookie, f"bench {index} {i}"))
+
+        started = time.perf_counter()
+        await asyncio.gather(*[poster(index, cookie) for index, cookie in enumerate(cookies)])
+        posted = time.perf_counter()
+        if self.expected_deliveries:
+            try:
+                await asyncio.wait_for(self.all_delivered.wait(), DELIVERY_TIMEOUT)
+            except asyncio.TimeoutError:
+                log(f"Only {len(self.delivery_latencies)} of {self.expected_deliveries} deliveries arrived")
+        for socket in sockets:
+            socket.close()
+
+        delivered = (self.last_delivery or posted) - started
+        return {
+            "post": {
+                "messages": len(post_latencies),
+                "seconds": round(posted - started, 3),
+                "per_second": round(len(post_latencies) / (posted - started), 1),
+                "latency": summarize(post_latencies)
+            },
+            "delivery": {
+                "expected": self.expected_deliveries,
+                "delivered": len(self.delivery_latencies),
+                "per_second": round(len(self.delivery_latencies) / delivered, 1) if delivered > 0 else 0,
+                "latency": summarize(self.delivery_latencies)
+            }
+        }, cookies[0]
+
+    async def run_uploads(self, cookie):
+        latencies = []
+        started = time.perf_counter()
+        for i in range(self.options.uploads):
+            body = os.urandom(UPLOAD_SIZE // 2).hex().encode()
+            upload_started = time.perf_counter()
+            response = await self.fetch(f"/api/uploads?filename=bench{i}.txt", cookie,
+                                        method="POST", body=body)
+            if response.code != 201:
+                raise RuntimeError(f"POST /api/uploads returned {response.code}")
+            attachment_id = json.loads(response.body)["data"]["id"]
+            await self.post(cookie, f"bench upload {i}", attachment_id)
+            latencies.append(time.perf_counter() - upload_started)
+        elapsed = time.perf_counter() - started
+        return {
+            "uploads": len(latencies),
+            "bytes": UPLOAD_SIZE,
+            "per_second": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0,
+            "latency": summarize(latencies)
+        }
+
+    async def run_history(self, cookie):
+        latencies = []
+        before = None
+        started = time.perf_counter()
+        for _ in range(self.options.pages):
+            query = {"room": ROOM, "limit": HISTORY_PAGE_SIZE}
+            if before is not None:
+                query["before"] = before
+            page_started = time.perf_counter()
+            response = await self.fetch("/api/messages?" + urllib.parse.urlencode(query), cookie)
+            latencies.append(time.perf_counter() - page_started)
+            if response.code != 200:
+                raise RuntimeError(f"GET /api/messages returned {response.code}")
+            # Page back to the oldest message, then start over from the newest
+            before = json.loads(response.body)["data"]["next_before"]
+        elapsed = time.perf_counter() - started
+        return {
+            "pages": len(latencies),
+            "page_size": HISTORY_PAGE_SIZE,
+            "per_second": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0,
+            "latency": summarize(latencies)
+        }
+
+    async def run(self):
+        await self.start()
+        try:
+            results, cookie = await self.run_posts()
+            log("posts done")
+            results["upload"] = await self.run_uploads(cookie)
+            log("uploads done")
+            results["history"] = await self.run_history(cookie)
+            log("history done")
+        finally:
+            await self.stop()
+        return results
+
+
+def compare(results, baseline):
+    """Summary lines, with the change against a previous run where there is one"""
+    lines = []
+    for section, values in results.items():
+        previous = baseline.get(section, {})
+        metrics = [("per_second", values.get("per_second"), previous.get("per_second"))]
+        for key in ("p50_ms", "p99_ms"):
+            metrics.append((key, values.get("latency", {}).get(key),
+                            previous.get("latency", {}).get(key)))
+        for name, value, old in metrics:
+            if value is None:
+                continue
+            line = f"{section:>9} {name:<10} {value:>10}"
+            if old:
+                line += f"  ({(value - old) / old * 100:+.1f}% vs {old})"
+            lines.append(line)
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chat server in-process")
+    parser.add_argument("--subscribers", type=int, default=50, help="WebSocket clients in the room")
+    parser.add_argument("--posters", type=int, default=10, help="clients posting concurrently")
+    parser.add_argument("--messages", type=int, default=50, help="messages per poster")
+    parser.add_argument("--uploads", type=int, default=20, help="files uploaded and posted")
+    parser.add_argument("--pages", type=int, default=200, help="history pages read")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    options = parser.parse_args()
+
+    AsyncHTTPClient.configure(None, max_clients=max(10, options.posters + 2))
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    try:
+        # The server logs to stdout, which is reserved for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results = asyncio.run(Benchmark(options, workdir).run())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": {key: value for key, value in vars(options).items() if key != "baseline"},
+        "results": results
+    }
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)["results"]
+    for line in compare(results, baseline):
+        log(line)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
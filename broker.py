@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import socket
+import struct
+from collections import deque
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError, StreamBufferFullError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+
+log = logging.getLogger(__name__)
+
+# Frames on the wire are a 4-byte big-endian length and then "<channel>\0<data>"
+HEADER = struct.Struct(">I")
+# Seconds to wait before reconnecting to a hub that went away
+RECONNECT_DELAY = 1.0
+# Frames kept while the hub is unreachable; the oldest are dropped beyond this
+PENDING_LIMIT = 10000
+# Per-stream write buffer before a peer counts as stuck
+MAX_BUFFER = 64 * 1024 * 1024
+
+
+def encode_frame(channel, data):
+    payload = channel.encode() + b"\0" + data
+    return HEADER.pack(len(payload)) + payload
+
+
+class Broker:
+    """Publish/subscribe on named channels with bytes payloads.
+
+    Every published message is delivered to the subscribers of every process
+    sharing the broker, including the publisher's own.
+    """
+
+    def __init__(self):
+        # channel -> callbacks taking the payload
+        self.subscribers = {}
+
+    def subscribe(self, channel, callback):
+        self.subscribers.setdefault(channel, []).append(callback)
+
+    def dispatch(self, channel, data):
+        for callback in self.subscribers.get(channel, ()):
+            try:
+                callback(data)
+            except Exception:
+                log.exception("Broker subscriber for %s failed", channel)
+
+    def publish(self, channel, data):
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class InMemoryBroker(Broker):
+    """Delivers synchronously inside this process; for single-worker setups"""
+
+    def publish(self, channel, data):
+        self.dispatch(channel, data)
+
+
+class UnixSocketBroker(Broker):
+    """Client of a BrokerHub listening on a local Unix socket"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.stream = None
+        self.closed = False
+        self.pending = deque(maxlen=PENDING_LIMIT)
+
+    def start(self):
+        IOLoop.current().spawn_callback(self.run)
+
+    async def run(self):
+        while not self.closed:
+            stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM),
+                              max_write_buffer_size=MAX_BUFFER)
+            try:
+                await stream.connect(self.path)
+            except (StreamClosedError, OSError) as e:
+                log.warning("Broker hub at %s unavailable: %s", self.path, e)
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            self.stream = stream
+            while self.pending:
+                stream.write(self.pending.popleft())
+            try:
+                while True:
+                    header = await stream.read_bytes(HEADER.size)
+                    (length,) = HEADER.unpack(header)
+                    payload = await stream.read_bytes(length)
+                    channel, _, data = payload.partition(b"\0")
+                    self.dispatch(channel.decode(), data)
+            except StreamClosedError:
+                if not self.closed:
+                    log.warning("Lost connection to broker hub at %s", self.path)
+            self.stream = None
+            if not self.closed:
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    def publish(self, channel, data):
+        frame = encode_frame(channel, data)
+        if self.stream is None:
+            self.pending.append(frame)
+            return
+        try:
+            self.stream.write(frame)
+        except (StreamClosedError, StreamBufferFullError):
+            self.pending.append(frame)
+
+    def close(self):
+        self.closed = True
+        if self.stream is not None:
+            self.stream.close()
+
+
+class BrokerHub(TCPServer):
+    """Relays every frame it receives to all connected workers, sender included"""
+
+    def __init__(self):
+        super().__init__(max_buffer_size=MAX_BUFFER)
+        self.streams = set()
+
+    async def handle_stream(self, stream, address):
+        stream.max_write_buffer_size = MAX_BUFFER
+        self.streams.add(stream)
+        try:
+            while True:
+                header = await stream.read_bytes(HEADER.size)
+                (length,) = HEADER.unpack(header)
+                frame = header + await stream.read_bytes(length)
+                for peer in list(self.streams):
+                    try:
+                        peer.write(frame)
+                    except (StreamClosedError, StreamBufferFullError):
+                        # A worker that stopped reading would stall everyone
+                        self.streams.discard(peer)
+                        peer.close()
+        except StreamClosedError:
+            pass
+        finally:
+            self.streams.discard(stream)
+
+
+def run_hub(path):
+    """Serve a BrokerHub on `path` until the process is killed"""
+    async def serve():
+        hub = BrokerHub()
+        hub.add_socket(bind_unix_socket(path))
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+def make_broker(url):
+    if url == "memory":
+        return InMemoryBroker()
+    if url.startswith("unix:"):
+        return UnixSocketBroker(url[len("unix:"):])
+    raise ValueError(f"Unknown broker URL: {url}")
@@ -0,0 +1,156 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Small bounded mapping that evicts the least recently used key.
+
+    Only touched from the IOLoop thread, so it needs no locking.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Newest messages kept per room, enough for a full /chat page
+RECENT_MESSAGES = 100
+# Rooms kept in memory; the least recently read one is dropped beyond this
+RECENT_ROOMS = 256
+
+
+class RecentMessages:
+    """The newest messages of recently read rooms, newest first.
+
+    Entries are the dicts returned by chat_db.get_message and are shared with
+    callers, who must treat them as read-only. A room is either absent or
+    holds its newest `per_room` messages (all of them when `complete`), so a
+    page is served from memory only when it lies wholly inside that window.
+    Only touched from the IOLoop thread.
+    """
+
+    def __init__(self, per_room=RECENT_MESSAGES, max_rooms=RECENT_ROOMS):
+        self.per_room = per_room
+        self.max_rooms = max_rooms
+        # room -> messages, newest first
+        self._rooms = OrderedDict()
+        # rooms with fewer messages in total than per_room
+        self._complete = set()
+        # message id -> room, for updates that only know the id
+        self._room_of = {}
+        # Bumped on every change; a load that raced a change is discarded
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, room, limit, before=None):
+        """Up to `limit` messages older than `before`, or None on a miss"""
+        messages = self._rooms.get(room)
+        if messages is not None and before is not None:
+            messages = [message for message in messages if message['id'] < before]
+        if messages is None or (len(messages) < limit and room not in self._complete):
+            self.misses += 1
+            return None
+        self._rooms.move_to_end(room)
+        self.hits += 1
+        return messages[:limit]
+
+    def find(self, message_id):
+        """The cached copy of one message, or None"""
+        room = self._room_of.get(message_id)
+        if room is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return next(message for message in self._rooms[room] if message['id'] == message_id)
+
+    def load(self, room, messages, complete, generation):
+        """Store a room's newest messages as read at `generation`"""
+        if generation != self.generation:
+            return
+        self._drop(room)
+        messages = messages[:self.per_room]
+        self._rooms[room] = messages
+        for message in messages:
+            self._room_of[message['id']] = room
+        if complete:
+            self._complete.add(room)
+        while len(self._rooms) > self.max_rooms:
+            self._drop(next(iter(self._rooms)))
+
+    def add(self, message):
+        """Insert or replace a message; ignored when its room isn't cached"""
+        self.generation += 1
+        room = message['room']
+        if self._room_of.get(message['id'], room) != room:
+            self.remove(message['id'])
+        messages = self._rooms.get(room)
+        if messages is None:
+            return
+        for i, cached in enumerate(messages):
+            if cached['id'] == message['id']:
+                messages[i] = message
+                return
+            if cached['id'] < message['id']:
+                messages.insert(i, message)
+                break
+        else:
+            # Older than the window: only a complete room has no gap before it
+            if room not in self._complete:
+                return
+            messages.append(message)
+        self._room_of[message['id']] = room
+        if len(messages) > self.per_room:
+            del self._room_of[messages.pop()['id']]
+            self._complete.discard(room)
+
+    def remove(self, message_id):
+        self.generation += 1
+        room = self._room_of.pop(message_id, None)
+        if room is not None:
+            self._rooms[room] = [message for message in self._rooms[room] if message['id'] != message_id]
+
+    def forget(self, room):
+        """Drop a room whose older messages changed (e.g. were archived)"""
+        self.generation += 1
+        self._drop(room)
+
+    def _drop(self, room):
+        for message in self._rooms.pop(room, ()):
+            self._room_of.pop(message['id'], None)
+        self._complete.discard(room)
+
+    def clear(self):
+        self._rooms.clear()
+        self._complete.clear()
+        self._room_of.clear()
+        self.generation += 1
+
+    def __len__(self):
+        return len(self._room_of)
@@ -0,0 +1,73 @@
+import os
+import secrets
+
+# Server
+PORT = int(os.environ.get("CHAT_PORT", 8989))
+# Worker processes sharing the port; 0 starts one per CPU core
+WORKERS = int(os.environ.get("CHAT_WORKERS", 1))
+
+# Every worker and every instance behind the load balancer must use the same
+# secret, otherwise a session cookie is only valid on the process that set it.
+# The generated fallback is shared by forked workers but not across restarts.
+COOKIE_SECRET = os.environ.get("CHAT_COOKIE_SECRET") or secrets.token_hex(32)
+
+# Pub/sub backbone carrying broadcasts between workers:
+#   "memory"              single process only
+#   "unix:/path/to/sock"  local hub process, started by app.py when needed
+BROKER_URL = os.environ.get("CHAT_BROKER", "memory")
+
+# Attachment blobs without references are deleted by a background job every
+# BLOB_GC_INTERVAL seconds once unreferenced for BLOB_GC_GRACE seconds
+BLOB_GC_INTERVAL = int(os.environ.get("CHAT_BLOB_GC_INTERVAL", 600))
+BLOB_GC_GRACE = int(os.environ.get("CHAT_BLOB_GC_GRACE", 600))
+
+# Retention: messages older than CHAT_RETENTION_DAYS, or beyond the newest
+# CHAT_RETENTION_ROWS of their room, move to monthly archive files in
+# CHAT_ARCHIVE_DIR (default "archive" next to the database), where history
+# paging still finds them. 0 turns a limit off.
+RETENTION_DAYS = int(os.environ.get("CHAT_RETENTION_DAYS", 0))
+RETENTION_ROWS = int(os.environ.get("CHAT_RETENTION_ROWS", 0))
+ARCHIVE_DIR = os.environ.get("CHAT_ARCHIVE_DIR") or None
+# Archival and incremental vacuum run every MAINTENANCE_INTERVAL seconds,
+# ANALYZE every ANALYZE_INTERVAL seconds
+MAINTENANCE_INTERVAL = int(os.environ.get("CHAT_MAINTENANCE_INTERVAL", 3600))
+ANALYZE_INTERVAL = int(os.environ.get("CHAT_ANALYZE_INTERVAL", 86400))
+
+# Rate limits, 0 turns one off. Per user: message posts, edits and deletions
+# per second (with bursts of RATE_POSTS_BURST) and upload bytes per second;
+# uploads beyond the rate are slowed down, and refused with a 429 once a
+# user's queued upload bytes would take UPLOAD_MAX_WAIT seconds. Per
+# WebSocket connection: inbound frames per second; a connection that keeps
+# sending past its burst is closed with code 1008.
+RATE_POSTS = float(os.environ.get("CHAT_RATE_POSTS", 5))
+RATE_POSTS_BURST = int(os.environ.get("CHAT_RATE_POSTS_BURST", 20))
+RATE_UPLOAD_BYTES = int(os.environ.get("CHAT_RATE_UPLOAD_BYTES", 5 * 1024 * 1024))
+UPLOAD_MAX_WAIT = int(os.environ.get("CHAT_UPLOAD_MAX_WAIT", 30))
+RATE_WS_FRAMES = float(os.environ.get("CHAT_RATE_WS_FRAMES", 20))
+RATE_WS_FRAMES_BURST = int(os.environ.get("CHAT_RATE_WS_FRAMES_BURST", 40))
+# Posts and uploads are admitted more slowly, for everyone, while the
+# average database write takes longer than this many seconds
+BACKPRESSURE_LATENCY = float(os.environ.get("CHAT_BACKPRESSURE_LATENCY", 0.1))
+
+# Password hashing: "scrypt" or "pbkdf2_sha256", with scrypt's n or PBKDF2's
+# iteration count as the cost (empty for the hasher's default). Changing
+# either rehashes a user's password at their next login.
+PASSWORD_HASHER = os.environ.get("CHAT_PASSWORD_HASHER", "scrypt")
+PASSWORD_COST = int(os.environ.get("CHAT_PASSWORD_COST") or 0) or None
+
+# permessage-deflate for clients of the compact WebSocket protocol; "0" turns it off
+WS_COMPRESSION = os.environ.get("CHAT_WS_COMPRESSION", "1") != "0"
+
+# Logging: CHAT_LOG_LEVEL is DEBUG, INFO, WARNING or ERROR; CHAT_LOG_FORMAT is
+# "text" (key=value pairs) or "json" (one object per line)
+LOG_LEVEL = os.environ.get("CHAT_LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("CHAT_LOG_FORMAT", "text")
+
+# Metrics are not public. Set CHAT_METRICS_PORT to give worker n its own
+# /metrics on CHAT_METRICS_PORT + n, listening on CHAT_METRICS_ADDRESS
+# (localhost unless changed). Setting CHAT_METRICS_TOKEN also serves /metrics on
+# the main port to requests with "Authorization: Bearer <token>"; there, with
+# several workers, each scrape sees whichever worker answered.
+METRICS_PORT = int(os.environ.get("CHAT_METRICS_PORT") or 0)
+METRICS_ADDRESS = os.environ.get("CHAT_METRICS_ADDRESS", "127.0.0.1")
+METRICS_TOKEN = os.environ.get("CHAT_METRICS_TOKEN") or None
@@ -1,17 +1,44 @@
-ALLOWED_MIME_TYPES = {
-    # Images
-    'image/': ['.jpg', '.jpeg', '.png', '.gif', '.webp'],
-    # Videos
-    'video/': ['.mp4', '.webm'],
-    # Audio
-    'audio/': ['.mp3', '.ogg'],
-    # Documents
-    'application/pdf': ['.pdf'],
-    'text/': ['.txt']
-}
-MAX_FILE_SIZES = {
-    'image': 5 * 1024 * 1024,      # 5MB for images
-    'video': 50 * 1024 * 1024,     # 50MB for videos
-    'audio': 10 * 1024 * 1024,     # 10MB for audio
-    'document': 20 * 1024 * 1024   # 20MB for documents
-}
\ No newline at end of file
+import mimetypes
+import os
+
+ALLOWED_MIME_TYPES = {
+    # Images
+    'image/': ['.jpg', '.jpeg', '.png', '.gif', '.webp'],
+    # Videos
+    'video/': ['.mp4', '.webm'],
+    # Audio
+    'audio/': ['.mp3', '.ogg'],
+    # Documents
+    'application/pdf': ['.pdf'],
+    'text/': ['.txt']
+}
+MAX_FILE_SIZES = {
+    'image': 5 * 1024 * 1024,      # 5MB for images
+    'video': 50 * 1024 * 1024,     # 50MB for videos
+    'audio': 10 * 1024 * 1024,     # 10MB for audio
+    'document': 20 * 1024 * 1024   # 20MB for documents
+}
+
+# Largest request body buffered in memory: a multipart form with the biggest
+# allowed file plus room for the other fields. /api/uploads streams and sets
+# its own limit per file type.
+MAX_FORM_BODY_SIZE = max(MAX_FILE_SIZES.values()) + 64 * 1024
+
+
+def check_file(file_name):
+    """Validate an upload by its name; returns (mime_type, extension, max_size)"""
+    mime_type, _ = mimetypes.guess_type(file_name)
+    if not mime_type:
+        raise ValueError("Unsupported file type")
+
+    # Keys are either a full MIME type or a 'type/' prefix
+    category = mime_type.split('/')[0]
+    allowed = ALLOWED_MIME_TYPES.get(mime_type, ALLOWED_MIME_TYPES.get(f"{category}/"))
+    if allowed is None:
+        raise ValueError("Unsupported file type")
+
+    file_ext = os.path.splitext(file_name)[1].lower()
+    if file_ext not in allowed:
+        raise ValueError("Invalid file extension for type")
+
+    return mime_type, file_ext, MAX_FILE_SIZES.get(category, MAX_FILE_SIZES['document'])
@@ -0,0 +1,48 @@
+import json
+import logging
+import sys
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+class StructuredFormatter(logging.Formatter):
+    """One line per record: time, level, logger, pid, message and any
+    fields passed as `extra`, either as JSON or as key=value pairs"""
+
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        fields = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "message": record.getMessage()
+        }
+        fields.update((key, value) for key, value in record.__dict__.items()
+                      if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            fields["exception"] = self.formatException(record.exc_info)
+
+        if self.json_lines:
+            return json.dumps(fields, default=str)
+        return " ".join(f"{key}={self.quote(value)}" for key, value in fields.items())
+
+    @staticmethod
+    def quote(value):
+        value = str(value)
+        if not value or any(c in value for c in ' ="\n'):
+            return json.dumps(value)
+        return value
+
+
+def setup(level="INFO", format="text"):
+    """Send every logger's records at `level` and above to stderr"""
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(StructuredFormatter(json_lines=format == "json"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
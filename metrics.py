@@ -0,0 +1,242 @@
+import asyncio
+import bisect
+import math
+import threading
+import time
+
+# Histogram buckets (seconds) for request and query latencies
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Fan-out to a room's sockets is much faster than a request
+FANOUT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1)
+# How often the IOLoop's scheduling delay is sampled (seconds)
+IOLOOP_LAG_INTERVAL = 0.5
+
+
+class Registry:
+    """Metrics rendered together by /metrics, in registration order"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """The Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named family of values, one per combination of label values.
+
+    Updates may come from any thread (database queries are timed on the
+    database's own), so each family has a lock; it is only held for the few
+    additions of an update. `function`, when given, is called at render time
+    instead and returns the value, or {label values tuple: value}.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), function=None, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._lock = threading.Lock()
+        # label values tuple -> child
+        self._children = {}
+        registry.register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def set_function(self, function):
+        self.function = function
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _label_pairs(self, values):
+        return list(zip(self.labelnames, values))
+
+    def samples(self):
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            for label_values, value in values.items():
+                yield "", self._label_pairs(label_values), value
+            return
+        for label_values, child in list(self._children.items()):
+            for suffix, extra, value in child.samples():
+                yield suffix, self._label_pairs(label_values) + extra, value
+
+    # Families without labels are updated directly
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class _Value:
+
+    def __init__(self, lock):
+        self._lock = lock
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        yield "", [], self.value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+
+class _Buckets:
+
+    def __init__(self, lock, bounds):
+        self._lock = lock
+        self.bounds = bounds
+        # Per bucket, not cumulative; the last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            cumulative += count
+            yield "_bucket", [("le", format_value(bound))], cumulative
+        yield "_sum", [], total
+        yield "_count", [], cumulative
+
+
+class _Timer:
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry=registry)
+
+    def _new_child(self):
+        return _Buckets(self._lock, self.buckets)
+
+    def time(self):
+        return self.labels().time()
+
+
+# The server's metrics
+
+HTTP_REQUEST_DURATION = Histogram(
+    "chat_http_request_duration_seconds", "Time to answer an HTTP request", ["handler", "method"])
+HTTP_RESPONSES = Counter(
+    "chat_http_responses_total", "HTTP responses sent", ["handler", "method", "code"])
+DB_QUERY_DURATION = Histogram(
+    "chat_db_query_duration_seconds", "Time spent in a chat_db method on a database thread", ["method"])
+DB_QUERY_ERRORS = Counter(
+    "chat_db_query_errors_total", "chat_db method calls that raised", ["method"])
+FANOUT_DURATION = Histogram(
+    "chat_fanout_duration_seconds", "Time to queue one event for a room's sockets", buckets=FANOUT_BUCKETS)
+FANOUT_FRAMES = Counter(
+    "chat_fanout_frames_total", "Frames queued for WebSocket clients")
+DROPPED_FRAMES = Counter(
+    "chat_dropped_frames_total", "Frames dropped for clients too slow to take them")
+SLOW_CLIENT_DISCONNECTS = Counter(
+    "chat_slow_client_disconnects_total", "WebSocket clients closed for being too slow")
+WEBSOCKET_CONNECTIONS = Gauge(
+    "chat_websocket_connections", "Open WebSocket connections")
+UPLOAD_BYTES = Counter(
+    "chat_upload_bytes_total", "Bytes of attachments uploaded")
+CACHE_HITS = Counter(
+    "chat_cache_hits_total", "Lookups answered from an in-memory cache", ["cache"])
+CACHE_MISSES = Counter(
+    "chat_cache_misses_total", "Lookups an in-memory cache could not answer", ["cache"])
+RATE_LIMITED = Counter(
+    "chat_rate_limited_total", "Requests refused and frames dropped by a rate limit", ["limit"])
+DB_WRITE_LATENCY = Gauge(
+    "chat_db_write_latency_seconds", "Moving average of database write latency, queueing included")
+BACKPRESSURE_SCALE = Gauge(
+    "chat_backpressure_scale", "Fraction of the configured post and upload rates currently admitted")
+IOLOOP_LAG = Histogram(
+    "chat_ioloop_lag_seconds", "How late the IOLoop ran a callback scheduled on time")
+
+
+async def monitor_ioloop_lag(interval=IOLOOP_LAG_INTERVAL):
+    """Samples IOLOOP_LAG forever; a busy or blocked loop wakes up late"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        IOLOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
@@ -1,45 +1,298 @@
 import sqlite3
-import hashlib
-from datetime import datetime
+from datetime import datetime, timedelta
+import argparse
 import os
+import time
+import glob
+import html
+import re
+import logging
+
+log = logging.getLogger(__name__)
+
+DB_PATH = 'chatroom.db'
+# Messages posted without an explicit room land here
+DEFAULT_ROOM = 'general'
+# Search ranks only this many of the newest matches
+SEARCH_CANDIDATES = 2000
+# Words of context in a search result snippet
+SNIPPET_WORDS = 12
+# Messages moved to the archive per archive_messages call, so the write lock
+# is only held briefly
+ARCHIVE_BATCH = 500
+# Free pages handed back to the file system per incremental_vacuum call
+VACUUM_PAGES = 1000
+
+# Connection-level settings applied once per connection. WAL lets readers run
+# alongside the writer and NORMAL sync is safe under WAL while avoiding an
+# fsync on every commit.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+)
+
+
+
+def unescaped(column):
+    """SQL expression undoing tornado's xhtml_escape on a column, since
+    message content is stored escaped (' is &#x27; or, before tornado 6.3, &#39;)"""
+    return (f"replace(replace(replace(replace(replace(replace({column}, '&lt;', '<'), '&gt;', '>'), "
+            f"'&quot;', '\"'), '&#x27;', ''''), '&#39;', ''''), '&amp;', '&')")
+
+
+# Schema migrations, applied in order. PRAGMA user_version stores how many have
+# already run, so a new connection only pays for the ones it is missing.
+MIGRATIONS = [
+    # 1: initial schema
+    """CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            creation_time TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            has_attachment BOOLEAN DEFAULT 0,
+            attachment_id INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (attachment_id) REFERENCES attachments (id));
+    CREATE TABLE IF NOT EXISTS attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            file_name TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            mime_type TEXT NOT NULL,
+            hash_sha256 TEXT NOT NULL,
+            upload_time TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id));""",
+    # 2: indexes for history paging and the attachment/user joins
+    """CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp);
+    CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id);
+    CREATE INDEX IF NOT EXISTS idx_messages_attachment_id ON messages (attachment_id);""",
+    # 3: rooms; history is always read per room, so page within the room
+    f"""ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT '{DEFAULT_ROOM}';
+    DROP INDEX IF EXISTS idx_messages_timestamp;
+    CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id);
+    CREATE INDEX IF NOT EXISTS idx_messages_room_timestamp ON messages (room, timestamp);""",
+    # 4: content-addressed blobs. Attachments are references to a blob; the
+    # triggers keep ref_count in step and collect_garbage removes the rest.
+    """CREATE TABLE IF NOT EXISTS blobs (
+            hash_sha256 TEXT PRIMARY KEY,
+            file_path TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0,
+            created_time TEXT NOT NULL,
+            released_time TEXT);
+    INSERT OR IGNORE INTO blobs (hash_sha256, file_path, file_size, ref_count, created_time)
+        SELECT hash_sha256, file_path, file_size, COUNT(*), MIN(upload_time)
+        FROM attachments GROUP BY hash_sha256;
+    CREATE INDEX IF NOT EXISTS idx_attachments_hash ON attachments (hash_sha256);
+    CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced ON blobs (released_time) WHERE ref_count <= 0;
+    CREATE TRIGGER IF NOT EXISTS attachments_blob_ref AFTER INSERT ON attachments BEGIN
+        INSERT INTO blobs (hash_sha256, file_path, file_size, ref_count, created_time)
+        VALUES (NEW.hash_sha256, NEW.file_path, NEW.file_size, 1, NEW.upload_time)
+        ON CONFLICT (hash_sha256) DO UPDATE SET ref_count = ref_count + 1, released_time = NULL;
+    END;
+    CREATE TRIGGER IF NOT EXISTS attachments_blob_unref AFTER DELETE ON attachments BEGIN
+        UPDATE blobs SET ref_count = ref_count - 1,
+            released_time = CASE WHEN ref_count <= 1 THEN datetime('now', 'localtime') END
+        WHERE hash_sha256 = OLD.hash_sha256;
+    END;""",
+    # 5: per-message revision, bumped on every edit so clients can order
+    # edit/delete events for the same message
+    """ALTER TABLE messages ADD COLUMN revision INTEGER NOT NULL DEFAULT 0;""",
+    # 6: full-text search over message text and attachment names, keyed by
+    # message id. Triggers keep it in step with every insert, edit and delete;
+    # the prefix indexes keep search-as-you-type queries from expanding into
+    # thousands of terms.
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, file_name, room UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3');
+    INSERT INTO messages_fts (rowid, content, file_name, room)
+        SELECT messages.id, messages.content, attachments.file_name, messages.room
+        FROM messages LEFT JOIN attachments ON messages.attachment_id = attachments.id;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content, file_name, room)
+        VALUES (NEW.id, NEW.content,
+                (SELECT file_name FROM attachments WHERE id = NEW.attachment_id), NEW.room);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content, attachment_id, room ON messages BEGIN
+        UPDATE messages_fts SET content = NEW.content, room = NEW.room,
+            file_name = (SELECT file_name FROM attachments WHERE id = NEW.attachment_id)
+        WHERE rowid = NEW.id;
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        DELETE FROM messages_fts WHERE rowid = OLD.id;
+    END;""",
+    # 7: per-user read position in each room, written in batches
+    """CREATE TABLE IF NOT EXISTS read_watermarks (
+            user_id INTEGER NOT NULL,
+            room TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            updated_time TEXT NOT NULL,
+            PRIMARY KEY (room, user_id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        ) WITHOUT ROWID;""",
+    # 8: archival. Attachments of archived messages stay (their messages now
+    # live in an archive file) and archives records which file holds which
+    # message ids of a room.
+    """ALTER TABLE attachments ADD COLUMN archived INTEGER NOT NULL DEFAULT 0;
+    CREATE TABLE IF NOT EXISTS archives (
+            name TEXT NOT NULL,
+            room TEXT NOT NULL,
+            min_id INTEGER NOT NULL,
+            max_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            PRIMARY KEY (name, room)
+        ) WITHOUT ROWID;""",
+    # 9: search the text as written rather than as stored (HTML escaped), so
+    # "amp" or "lt" no longer match every & or <; reindexes everything
+    f"""DROP TRIGGER IF EXISTS messages_fts_insert;
+    DROP TRIGGER IF EXISTS messages_fts_update;
+    DELETE FROM messages_fts;
+    INSERT INTO messages_fts (rowid, content, file_name, room)
+        SELECT messages.id, {unescaped('messages.content')}, attachments.file_name, messages.room
+        FROM messages LEFT JOIN attachments ON messages.attachment_id = attachments.id;
+    CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, content, file_name, room)
+        VALUES (NEW.id, {unescaped('NEW.content')},
+                (SELECT file_name FROM attachments WHERE id = NEW.attachment_id), NEW.room);
+    END;
+    CREATE TRIGGER messages_fts_update AFTER UPDATE OF content, attachment_id, room ON messages BEGIN
+        UPDATE messages_fts SET content = {unescaped('NEW.content')}, room = NEW.room,
+            file_name = (SELECT file_name FROM attachments WHERE id = NEW.attachment_id)
+        WHERE rowid = NEW.id;
+    END;""",
+]
+
+# Archive files, one per month of messages (messages-YYYY-MM.db). The columns
+# up to revision are in the order chat_db._message_dicts expects.
+ARCHIVE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            has_attachment INTEGER NOT NULL,
+            attachment_id INTEGER,
+            file_name TEXT,
+            file_path TEXT,
+            mime_type TEXT,
+            file_size INTEGER,
+            room TEXT NOT NULL,
+            revision INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            archived_time TEXT NOT NULL);
+    CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room, id);"""
+ARCHIVE_COLUMNS = """id, username, content, timestamp, has_attachment, attachment_id, file_name,
+    file_path, mime_type, file_size, room, revision"""
+
+
+def highlight(text, terms, prefix=None, size=SNIPPET_WORDS):
+    """Up to `size` words of plain text around the first search term found,
+    HTML escaped, with every term wrapped in <mark>; None when no term occurs
+    in text"""
+    words = list(re.finditer(r"\w+", text))
+    hits = [i for i, word in enumerate(words)
+            if word.group().casefold() in terms
+            or (prefix and word.group().casefold().startswith(prefix))]
+    if not hits:
+        return None
+    start = max(0, min(hits[0] - size // 4, len(words) - size))
+    window = words[start:start + size]
+    parts = ["…" if start > 0 else ""]
+    position = window[0].start() if start > 0 else 0
+    for i, word in enumerate(window, start):
+        parts.append(html.escape(text[position:word.start()]))
+        word_html = html.escape(word.group())
+        parts.append(f"<mark>{word_html}</mark>" if i in hits else word_html)
+        position = word.end()
+    parts.append(html.escape(text[position:]) if start + size >= len(words) else "…")
+    return "".join(parts)
+
 
 class chat_db:
 
-    def __init__(self):
-        self.connection = sqlite3.connect('chatroom.db')
+    def __init__(self, path=DB_PATH, migrate=True, archive_dir=None):
+        """Open a long-lived connection. Create one per process (or per thread)
+        and reuse it; sqlite3 keeps its prepared statements cached per connection.
+        Archived messages go to archive_dir, by default "archive" next to the database."""
+        self.path = path
+        self.archive_dir = archive_dir or os.path.join(os.path.dirname(os.path.abspath(path)), "archive")
+        # archive file name -> open connection
+        self._archives = {}
+        self.connection = sqlite3.connect(path, cached_statements=256)
         self.cursor = self.connection.cursor()
-        self.cursor.execute("PRAGMA foreign_keys = ON")
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS users (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            username TEXT UNIQUE NOT NULL,
-                            password TEXT NOT NULL,
-                            creation_time TEXT NOT NULL)""")
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS messages (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id INTEGER NOT NULL,
-                            content TEXT NOT NULL,
-                            timestamp TEXT NOT NULL,
-                            has_attachment BOOLEAN DEFAULT 0,
-                            attachment_id INTEGER,
-                            FOREIGN KEY (user_id) REFERENCES users (id),
-                            FOREIGN KEY (attachment_id) REFERENCES attachments (id)
-                            )""")
-        self.cursor.execute("""CREATE TABLE IF NOT EXISTS attachments (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            user_id INTEGER NOT NULL,
-                            file_name TEXT NOT NULL,
-                            file_path TEXT NOT NULL,
-                            file_size INTEGER NOT NULL,  
-                            mime_type TEXT NOT NULL,
-                            hash_sha256 TEXT NOT NULL,  
-                            upload_time TEXT NOT NULL,
-                            FOREIGN KEY (user_id) REFERENCES users(id)
-                        )""")      
-        self.connection.commit()
-
-
-    def create_user(self, username, password):
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
+        if self.cursor.execute("PRAGMA page_count").fetchone()[0] == 0:
+            # A new file; only takes effect before WAL mode writes the header
+            self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        for pragma in PRAGMAS:
+            self.cursor.execute(pragma)
+        if migrate:
+            self.migrate()
+
+    def migrate(self):
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+            # executescript commits first, so each migration runs in its own
+            # transaction together with the version bump
+            self.connection.executescript(
+                f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+            log.info("Applied database migration %s", number)
+
+        # Databases created before incremental vacuum need one full VACUUM to
+        # switch modes. That rewrites the whole file, so it is left to an
+        # explicit `python model.py --enable-incremental-vacuum` run.
+        if self.cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            log.warning(
+                "%s (%.1f MB) does not use incremental vacuum, so space freed by deletes and "
+                "archiving stays in the file. To convert it, stop the server and run "
+                "`python model.py --enable-incremental-vacuum %s`; it rewrites the whole file.",
+                self.path, self.size() / 1e6, self.path)
+
+    def size(self):
+        """Bytes in the database file (the WAL not included)"""
+        page_count = self.cursor.execute("PRAGMA page_count").fetchone()[0]
+        return page_count * self.cursor.execute("PRAGMA page_size").fetchone()[0]
+
+    def enable_incremental_vacuum(self):
+        """Switch an existing database to auto_vacuum = INCREMENTAL. The VACUUM
+        this needs rewrites the whole file, holding off every writer until it is
+        done and using about the file's size again in free disk space, so run
+        it with the server stopped. Returns False if it was already enabled."""
+        if self.cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        self.cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.cursor.execute("VACUUM")
+        return True
+
+    def close(self):
+        for archive in self._archives.values():
+            archive.close()
+        self._archives.clear()
+        self.connection.close()
+
+    def _archive(self, name):
+        """Connection to an archive file, created on first use"""
+        archive = self._archives.get(name)
+        if archive is None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            archive = sqlite3.connect(os.path.join(self.archive_dir, name))
+            archive.execute("PRAGMA journal_mode = WAL")
+            archive.execute("PRAGMA synchronous = NORMAL")
+            archive.executescript(ARCHIVE_SCHEMA)
+            self._archives[name] = archive
+        return archive
+
+    def create_user(self, username, hashed_password):
+        """hashed_password comes from passwords.PasswordHasher, not the plain password"""
         creation_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         try:
             self.cursor.execute("INSERT INTO users (username, password, creation_time) VALUES (?, ?, ?)",
@@ -47,14 +300,24 @@ class chat_db:
             self.connection.commit()
             return True
         except sqlite3.IntegrityError:
+            self.connection.rollback()
             return False
 
-    def authenticate_user(self, username, password):
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
-        self.cursor.execute("SELECT id, username FROM users WHERE username = ? AND password = ?",
-                            (username, hashed_password))
-        this_user = self.cursor.fetchall()
-        return this_user
+    def get_credentials(self, username):
+        """(id, username, password hash) of a user, or None; checking the
+        password is left to passwords.PasswordHasher"""
+        self.cursor.execute("SELECT id, username, password FROM users WHERE username = ?", (username,))
+        return self.cursor.fetchone()
+
+    def set_password(self, user_id, hashed_password):
+        try:
+            self.cursor.execute("UPDATE users SET password = ? WHERE id = ?", (hashed_password, user_id))
+            self.connection.commit()
+            return True
+        except sqlite3.Error as e:
+            log.error("Failed to update password: %s", e)
+            self.connection.rollback()
+            return False
     
     def get_user(self, username):
         self.cursor.execute("SELECT id FROM users WHERE username = ? ", (username,))
@@ -62,10 +325,16 @@ class chat_db:
         return this_user    
 
     def get_message_by_id(self, message_id):
-        self.cursor.execute("SELECT id, user_id, content, timestamp FROM messages WHERE id = ?", (message_id,))
+        self.cursor.execute("SELECT id, user_id, content, timestamp, room, revision FROM messages WHERE id = ?", (message_id,))
         return self.cursor.fetchone()
 
-    def save_message(self, user_id, content, timestamp=None, attachment_id=None):
+    def get_attachment(self, attachment_id):
+        self.cursor.execute("""SELECT file_name, file_path, mime_type, user_id, file_size, hash_sha256
+                            FROM attachments WHERE id = ?""",
+                            (attachment_id,))
+        return self.cursor.fetchone()
+
+    def save_message(self, user_id, content, timestamp=None, attachment_id=None, room=DEFAULT_ROOM):
         try:
             if timestamp is None:
                 timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -75,66 +344,282 @@ class chat_db:
             has_attachment = 1 if attachment_id is not None else 0
 
             self.cursor.execute(
-                "INSERT INTO messages (user_id, content, timestamp, has_attachment, attachment_id) VALUES (?, ?, ?, ?, ?)",
-                (user_id, content, timestamp, has_attachment, attachment_id)
+                "INSERT INTO messages (user_id, content, timestamp, has_attachment, attachment_id, room) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, content, timestamp, has_attachment, attachment_id, room)
             )
             self.connection.commit()
-            return True
+            return self.cursor.lastrowid  # Return message ID on success
         except sqlite3.Error as e:
-            print(f"Database error is {e}")
+            log.error("Failed to save message: %s", e)
+            self.connection.rollback()
             return False
 
-    def save_attachment(self, user_id, file_name, file_path, file_size, mime_type, hash_sha256):
+    def save_messages(self, rows):
+        """Insert many messages in one transaction, so a whole batch costs a
+        single commit. `rows` are (user_id, content, timestamp, attachment_id,
+        room) tuples; returns their ids in order, False for rows that failed."""
+        ids = []
+        try:
+            self.cursor.execute("BEGIN")
+            for user_id, content, timestamp, attachment_id, room in rows:
+                if timestamp is None:
+                    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                # A savepoint per row keeps one bad row from failing the batch
+                self.cursor.execute("SAVEPOINT message")
+                try:
+                    self.cursor.execute(
+                        "INSERT INTO messages (user_id, content, timestamp, has_attachment, attachment_id, room) VALUES (?, ?, ?, ?, ?, ?)",
+                        (user_id, content or "", timestamp, 1 if attachment_id is not None else 0, attachment_id, room)
+                    )
+                    ids.append(self.cursor.lastrowid)
+                except sqlite3.Error as e:
+                    log.error("Failed to save message: %s", e)
+                    self.cursor.execute("ROLLBACK TO message")
+                    ids.append(False)
+                self.cursor.execute("RELEASE message")
+            self.connection.commit()
+            return ids
+        except sqlite3.Error as e:
+            log.error("Failed to save message batch: %s", e)
+            self.connection.rollback()
+            return [False] * len(rows)
+
+    def save_messages_with_details(self, rows):
+        """save_messages, also returning the saved messages shaped like
+        get_message's, read back on the same connection: (ids, messages)"""
+        ids = self.save_messages(rows)
+        saved = [message_id for message_id in ids if message_id]
+        return ids, self.get_message_details(saved) if saved else []
+
+    def save_attachment(self, user_id, file_name, file_path, file_size, mime_type, hash_sha256, temp_path=None):
+        """Record an attachment referencing the blob at file_path. With temp_path
+        the uploaded file is moved into place here, unless the blob already exists."""
         upload_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        moved = False
         try:
+            # The write lock is taken before looking for the blob, and
+            # collect_garbage keeps it until its files are gone, so no
+            # process's GC can remove the blob between this check and the insert
+            self.cursor.execute("BEGIN IMMEDIATE")
             self.cursor.execute(
                 "INSERT INTO attachments (user_id, file_name, file_path, file_size, mime_type, hash_sha256, upload_time) VALUES (?, ?, ?, ?, ?, ?, ?)",
                 (user_id, file_name, file_path, file_size, mime_type, hash_sha256, upload_time)
             )
+            attachment_id = self.cursor.lastrowid
+            # The file only moves into place once its blob row is there
+            if temp_path is not None:
+                if os.path.exists(file_path):
+                    os.remove(temp_path)
+                else:
+                    os.replace(temp_path, file_path)
+                    moved = True
+            self.connection.commit()
+            return attachment_id  # Return attachment ID on success
+        except (sqlite3.Error, OSError) as e:
+            log.error("Failed to save attachment: %s", e)
+            self.connection.rollback()
+            # Neither the upload nor a blob file without a row may stay behind
+            for path in (temp_path, file_path if moved else None):
+                if path is not None:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            return None
+
+
+    def get_message(self, limit=100, before=None, before_time=None, room=DEFAULT_ROOM, after=None):
+        """Return up to `limit` messages of a room, newest first.
+
+        Pages are keyset based: pass the smallest id of the previous page as
+        `before` (walks idx_messages_room_id) or a timestamp as `before_time`
+        (walks idx_messages_room_timestamp), so every page costs the same
+        however deep it is. With `after`, the messages following that id are
+        returned oldest first instead, for catching up.
+        """
+        try:
+            conditions = ["messages.room = ?"]
+            params = [room]
+            if before is not None:
+                conditions.append("messages.id < ?")
+                params.append(before)
+            if after is not None:
+                conditions.append("messages.id > ?")
+                params.append(after)
+            if before_time is not None:
+                conditions.append("messages.timestamp < ?")
+                params.append(before_time)
+                order = "messages.timestamp DESC, messages.id DESC"
+            elif after is not None:
+                order = "messages.id ASC"
+            else:
+                order = "messages.id DESC"
+            return self._select_messages(conditions, params, order, limit)
+        except sqlite3.Error as e:
+            log.error("Failed to fetch messages: %s", e)
+            return []
+
+    def get_read_watermarks(self, room=DEFAULT_ROOM):
+        """{username: last read message id} for everyone who read the room"""
+        try:
+            self.cursor.execute("""
+                SELECT users.username, read_watermarks.message_id
+                FROM read_watermarks JOIN users ON read_watermarks.user_id = users.id
+                WHERE read_watermarks.room = ?
+            """, (room,))
+            return dict(self.cursor.fetchall())
+        except sqlite3.Error as e:
+            log.error("Failed to fetch read watermarks: %s", e)
+            return {}
+
+    def save_read_watermarks(self, rows):
+        """Store (user_id, room, message_id) rows in one transaction; a
+        watermark never moves backwards. Rows that can't be stored are logged
+        and skipped; returns False only if the transaction itself failed."""
+        updated_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            self.cursor.execute("BEGIN")
+            for user_id, room, message_id in rows:
+                # A savepoint per row keeps one bad row from failing the batch
+                self.cursor.execute("SAVEPOINT watermark")
+                try:
+                    self.cursor.execute("""
+                        INSERT INTO read_watermarks (user_id, room, message_id, updated_time)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT (room, user_id) DO UPDATE SET
+                            message_id = MAX(message_id, excluded.message_id),
+                            updated_time = excluded.updated_time
+                    """, (user_id, room, message_id, updated_time))
+                except (sqlite3.Error, OverflowError) as e:
+                    log.error("Failed to save read watermark of user %s in %s: %s", user_id, room, e)
+                    self.cursor.execute("ROLLBACK TO watermark")
+                self.cursor.execute("RELEASE watermark")
             self.connection.commit()
-            return self.cursor.lastrowid  # Return attachment ID on success
+            return True
+        except sqlite3.Error as e:
+            log.error("Failed to save read watermarks: %s", e)
+            self.connection.rollback()
+            return False
+
+    def get_message_detail(self, message_id):
+        """One message in the same shape as get_message, or None"""
+        try:
+            messages = self._select_messages(["messages.id = ?"], [message_id], "messages.id", 1)
+            return messages[0] if messages else None
         except sqlite3.Error as e:
-            print(f"[ERROR] Failed to save attachment: {e}")
+            log.error("Failed to fetch message %s: %s", message_id, e)
             return None
 
+    def get_message_details(self, message_ids):
+        """Several messages in the same shape as get_message, by id"""
+        try:
+            placeholders = ", ".join("?" * len(message_ids))
+            return self._select_messages([f"messages.id IN ({placeholders})"], list(message_ids),
+                                         "messages.id", len(message_ids))
+        except sqlite3.Error as e:
+            log.error("Failed to fetch messages %s: %s", message_ids, e)
+            return []
 
-    def get_message(self, limit=100):
+    def search_messages(self, query, room=DEFAULT_ROOM, limit=20, offset=0):
+        """Messages of a room matching `query`, best match first.
+
+        Every word of the query must appear in the text or the attachment
+        name; the last one may be a prefix, so results follow as you type.
+        Only the newest SEARCH_CANDIDATES matches are ranked, which keeps
+        common words as fast as rare ones. Each result carries a `snippet`
+        with the matches wrapped in <mark>.
+        """
+        words = query.split()
+        if not words:
+            return []
+        # Quote every word so FTS5 operators in user input are taken literally
+        match = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+        if len(words[-1]) >= 2:
+            match += "*"
         try:
             self.cursor.execute("""
-                SELECT messages.id, users.username, messages.content, messages.timestamp,
-                    messages.has_attachment, attachments.id, attachments.file_name, attachments.file_path, attachments.mime_type
-                FROM messages
-                JOIN users ON messages.user_id = users.id
-                LEFT JOIN attachments ON messages.attachment_id = attachments.id
-                ORDER BY messages.timestamp DESC
-                LIMIT ?
-            """, (limit,))
-            
-            messages = self.cursor.fetchall()
+                SELECT rowid FROM (
+                    SELECT rowid, bm25(messages_fts) AS score
+                    FROM messages_fts
+                    WHERE messages_fts MATCH ? AND room = ?
+                    ORDER BY rowid DESC
+                    LIMIT ?)
+                ORDER BY score
+                LIMIT ? OFFSET ?
+            """, (match, room, SEARCH_CANDIDATES, limit, offset))
+            message_ids = [row[0] for row in self.cursor.fetchall()]
+            if not message_ids:
+                return []
+            messages = {message['id']: message for message in self.get_message_details(message_ids)}
+            # Snippets are cut here rather than with FTS5's snippet(), which
+            # would expand a prefix into all its terms again for every row
+            terms = [term.casefold() for term in re.findall(r"\w+", query)]
+            prefix = terms[-1] if match.endswith("*") and terms else None
             result = []
-            for msg in messages:
-                msg_dict = {
-                    'id': msg[0],
-                    'username': msg[1],
-                    'content': msg[2],
-                    'timestamp': msg[3],
-                    'has_attachment': bool(msg[4]),
-                    'attachment': None
-                }
-                if msg[4]:
-                    msg_dict['attachment'] = {
-                        'id': msg[5],
-                        'file_name': msg[6],
-                        'file_path': msg[7],
-                        'mime_type': msg[8],
-                    }
-                result.append(msg_dict)
+            for message_id in message_ids:
+                if message_id not in messages:
+                    continue
+                message = messages[message_id]
+                # Content is stored escaped; terms are matched in the text as written
+                snippet = highlight(html.unescape(message['content']), terms, prefix)
+                if snippet is None and message['attachment']:
+                    snippet = highlight(message['attachment']['file_name'], terms, prefix)
+                result.append({**message, 'snippet': snippet or message['content']})
             return result
         except sqlite3.Error as e:
-            print(f"[ERROR] Failed to fetch messages: {e}")
+            log.error("Failed to search messages: %s", e)
             return []
 
-        
+    def _select_messages(self, conditions, params, order, limit):
+        where = f"WHERE {' AND '.join(conditions)}"
+        self.cursor.execute(f"""
+            SELECT messages.id, users.username, messages.content, messages.timestamp,
+                messages.has_attachment, attachments.id, attachments.file_name, attachments.file_path,
+                attachments.mime_type, attachments.file_size, messages.room, messages.revision
+            FROM messages
+            JOIN users ON messages.user_id = users.id
+            LEFT JOIN attachments ON messages.attachment_id = attachments.id
+            {where}
+            ORDER BY {order}
+            LIMIT ?
+        """, (*params, limit))
+        return self._message_dicts(self.cursor.fetchall())
+
+    @staticmethod
+    def _message_dicts(messages):
+        """Rows of (id, username, content, timestamp, has_attachment, attachment
+        id, file_name, file_path, mime_type, file_size, room, revision) as dicts"""
+        result = []
+        for msg in messages:
+            msg_dict = {
+                'id': msg[0],
+                'username': msg[1],
+                'content': msg[2],
+                'timestamp': msg[3],
+                'has_attachment': bool(msg[4]),
+                'attachment': None,
+                'room': msg[10],
+                'revision': msg[11]
+            }
+            if msg[4]:
+                msg_dict['attachment'] = {
+                    'id': msg[5],
+                    'file_name': msg[6],
+                    'file_path': msg[7],
+                    'mime_type': msg[8],
+                    'file_size': msg[9],
+                }
+            result.append(msg_dict)
+        return result
+
+    def get_last_message_id(self):
+        try:
+            self.cursor.execute("SELECT MAX(id) FROM messages")
+            return self.cursor.fetchone()[0] or 0
+        except sqlite3.Error as e:
+            log.error("Failed to fetch last message id: %s", e)
+            return None
+
     def delete_message(self, message_id):
         try:
             # Find attachment id and file path if message has attachment
@@ -143,7 +628,7 @@ class chat_db:
             """, (message_id,))
             row = self.cursor.fetchone()
             if not row:
-                print(f"[WARN] Message ID {message_id} not found.")
+                log.warning("Message ID %s not found", message_id)
                 return False
             
             attachment_id = row[0]
@@ -151,62 +636,38 @@ class chat_db:
             # Delete message first
             self.cursor.execute("DELETE FROM messages WHERE id = ?", (message_id,))
             if self.cursor.rowcount == 0:
-                print(f"[WARN] Message ID {message_id} could not be deleted.")
+                log.warning("Message ID %s could not be deleted", message_id)
+                self.connection.rollback()
                 return False
             
-            # If there's an attachment, delete attachment record and file
+            # The attachment record goes with it; the file stays until
+            # collect_garbage finds its blob unreferenced
             if attachment_id:
-                self.cursor.execute("SELECT file_path FROM attachments WHERE id = ?", (attachment_id,))
-                file_row = self.cursor.fetchone()
-                if file_row:
-                    file_path = file_row[0]
-                    # Delete the file from disk if exists
-                    try:
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                            print(f"[INFO] Deleted file: {file_path}")
-                    except Exception as e:
-                        print(f"[ERROR] Could not delete file {file_path}: {e}")
-
-                # Delete attachment record from DB
-                self.cursor.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
+                self.release_attachment(attachment_id)
             
             self.connection.commit()
             return True
 
         except sqlite3.Error as e:
-            print(f"[ERROR] Failed to delete message: {e}")
+            log.error("Failed to delete message: %s", e)
+            self.connection.rollback()
             return False
 
-    def edit_message(self, message_id, new_content, new_attachment=None):
+    def edit_message(self, message_id, new_content, new_attachment=None, new_attachment_id=None):
+        """Update a message's content and optionally replace its attachment,
+        either with a new attachment record or with an already uploaded one."""
 
         try:
             # Fetch old attachment id and user_id for the message
             self.cursor.execute("SELECT attachment_id, user_id FROM messages WHERE id = ?", (message_id,))
             row = self.cursor.fetchone()
             if not row:
-                print(f"[WARN] Message ID {message_id} not found.")
+                log.warning("Message ID %s not found", message_id)
                 return False
 
             old_attachment_id, user_id = row
 
-            # If there is a new attachment, handle deleting old attachment and saving new
             if new_attachment:
-                # Delete old attachment if exists
-                if old_attachment_id:
-                    self.cursor.execute("SELECT file_path FROM attachments WHERE id = ?", (old_attachment_id,))
-                    file_row = self.cursor.fetchone()
-                    if file_row:
-                        file_path = file_row[0]
-                        try:
-                            if os.path.exists(file_path):
-                                os.remove(file_path)
-                                print(f"[INFO] Deleted old file: {file_path}")
-                        except Exception as e:
-                            print(f"[ERROR] Could not delete old file {file_path}: {e}")
-
-                    self.cursor.execute("DELETE FROM attachments WHERE id = ?", (old_attachment_id,))
-                
                 # Save new attachment and get new ID
                 new_attachment_id = self.save_attachment(
                     user_id=user_id,  # Pass user_id here
@@ -216,17 +677,247 @@ class chat_db:
                     mime_type=new_attachment['mime_type'],
                     hash_sha256=new_attachment['hash_sha256']
                 )
-            else:
+            elif new_attachment_id is None:
                 new_attachment_id = old_attachment_id
 
             # Update the message content and attachment_id
             self.cursor.execute(
-                "UPDATE messages SET content = ?, attachment_id = ?, has_attachment = ? WHERE id = ?",
+                """UPDATE messages SET content = ?, attachment_id = ?, has_attachment = ?,
+                    revision = revision + 1 WHERE id = ?""",
                 (new_content, new_attachment_id, 1 if new_attachment_id else 0, message_id)
             )
+
+            # The old attachment can only go once nothing references it
+            if old_attachment_id and old_attachment_id != new_attachment_id:
+                self.release_attachment(old_attachment_id)
+
             self.connection.commit()
             return True
 
         except sqlite3.Error as e:
-            print(f"[ERROR] Failed to edit message: {e}")
+            log.error("Failed to edit message: %s", e)
+            self.connection.rollback()
             return False
+
+    def release_attachment(self, attachment_id):
+        """Drop an attachment record no message uses any more (part of the caller's transaction)"""
+        self.cursor.execute("""
+            DELETE FROM attachments WHERE id = ?
+            AND archived = 0
+            AND NOT EXISTS (SELECT 1 FROM messages WHERE messages.attachment_id = ?)
+        """, (attachment_id, attachment_id))
+
+    def collect_garbage(self, grace_seconds=600, batch_size=500):
+        """Delete blobs (rows and files) that have had no references for
+        grace_seconds, after dropping uploads never attached to a message.
+        Returns (blobs removed, bytes freed)."""
+        try:
+            cutoff = (datetime.now() - timedelta(seconds=grace_seconds)).strftime("%Y-%m-%d %H:%M:%S")
+            # The write lock is held until the files are gone, so save_attachment
+            # in any process either sees the blob removed or revives it first
+            self.cursor.execute("BEGIN IMMEDIATE")
+            self.cursor.execute("""
+                DELETE FROM attachments WHERE upload_time < ? AND archived = 0
+                AND NOT EXISTS (SELECT 1 FROM messages WHERE messages.attachment_id = attachments.id)
+            """, (cutoff,))
+
+            self.cursor.execute("""
+                SELECT hash_sha256, file_path, file_size FROM blobs
+                WHERE ref_count <= 0 AND released_time < ? LIMIT ?
+            """, (cutoff, batch_size))
+            garbage = []
+            for file_hash, file_path, file_size in self.cursor.fetchall():
+                # Still unreferenced, checked again right before the unlink
+                self.cursor.execute("DELETE FROM blobs WHERE hash_sha256 = ? AND ref_count <= 0", (file_hash,))
+                if self.cursor.rowcount:
+                    garbage.append((file_hash, file_path, file_size))
+
+            # Everything named after the hash belongs to the blob (other
+            # extensions, derived files)
+            freed = 0
+            for file_hash, file_path, _ in garbage:
+                for path in glob.glob(os.path.join(os.path.dirname(file_path), f"{file_hash}*")):
+                    try:
+                        freed += os.path.getsize(path)
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        log.error("Could not delete file %s: %s", path, e)
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.error("Failed to collect garbage: %s", e)
+            self.connection.rollback()
+            return 0, 0
+        return len(garbage), freed
+
+    def archive_messages(self, max_age_days=0, max_rows=0, batch_size=ARCHIVE_BATCH):
+        """Move up to batch_size messages that fall outside the retention
+        policy (older than max_age_days, or beyond the newest max_rows of
+        their room; 0 turns a limit off) into the monthly archive files.
+        Returns (messages moved, rooms they came from).
+
+        The rows are copied and committed to the archive first and only then
+        deleted here; a crash in between leaves them in both, and the next run
+        copies them again harmlessly (INSERT OR IGNORE) before deleting them.
+        """
+        if not max_age_days and not max_rows:
+            return 0, []
+        cutoff = (datetime.now() - timedelta(days=max_age_days)).strftime("%Y-%m-%d %H:%M:%S")
+        batch = []
+        try:
+            # Distinct rooms, one index seek each
+            rooms = [row[0] for row in self.cursor.execute("""
+                WITH RECURSIVE rooms (room) AS (
+                    SELECT MIN(room) FROM messages
+                    UNION ALL
+                    SELECT (SELECT MIN(room) FROM messages WHERE room > rooms.room)
+                    FROM rooms WHERE rooms.room IS NOT NULL)
+                SELECT room FROM rooms WHERE room IS NOT NULL
+            """).fetchall()]
+            for room in rooms:
+                if len(batch) >= batch_size:
+                    break
+                # Everything up to the newest message outside the policy goes
+                threshold = None
+                if max_rows:
+                    row = self.cursor.execute(
+                        "SELECT id FROM messages WHERE room = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                        (room, max_rows)).fetchone()
+                    threshold = row and row[0]
+                if max_age_days:
+                    row = self.cursor.execute("""
+                        SELECT id FROM messages WHERE room = ? AND timestamp < ?
+                        ORDER BY timestamp DESC LIMIT 1
+                    """, (room, cutoff)).fetchone()
+                    if row:
+                        threshold = max(threshold or 0, row[0])
+                if threshold is None:
+                    continue
+                batch.extend(self.cursor.execute("""
+                    SELECT messages.id, users.username, messages.content, messages.timestamp,
+                        messages.has_attachment, attachments.id, attachments.file_name,
+                        attachments.file_path, attachments.mime_type, attachments.file_size,
+                        messages.room, messages.revision, messages.user_id
+                    FROM messages
+                    JOIN users ON messages.user_id = users.id
+                    LEFT JOIN attachments ON messages.attachment_id = attachments.id
+                    WHERE messages.room = ? AND messages.id <= ?
+                    ORDER BY messages.id
+                    LIMIT ?
+                """, (room, threshold, batch_size - len(batch))).fetchall())
+        except sqlite3.Error as e:
+            log.error("Failed to select messages to archive: %s", e)
+            return 0, []
+        if not batch:
+            return 0, []
+
+        # Phase 1: copy into the archive files, grouped by month
+        archived_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        months = {}
+        for row in batch:
+            months.setdefault(f"messages-{row[3][:7]}.db", []).append(row)
+        try:
+            for name, rows in months.items():
+                archive = self._archive(name)
+                with archive:
+                    archive.executemany(
+                        f"INSERT OR IGNORE INTO messages ({ARCHIVE_COLUMNS}, user_id, archived_time) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(*row, archived_time) for row in rows])
+        except sqlite3.Error as e:
+            log.error("Failed to write archive: %s", e)
+            return 0, []
+
+        # Phase 2: drop them from the live database
+        try:
+            self.cursor.executemany("UPDATE attachments SET archived = 1 WHERE id = ?",
+                                    [(row[5],) for row in batch if row[5] is not None])
+            self.cursor.executemany("DELETE FROM messages WHERE id = ?", [(row[0],) for row in batch])
+            for name, rows in months.items():
+                rooms = {}
+                for row in rows:
+                    rooms.setdefault(row[10], []).append(row[0])
+                self.cursor.executemany("""
+                    INSERT INTO archives (name, room, min_id, max_id, message_count) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (name, room) DO UPDATE SET
+                        min_id = MIN(min_id, excluded.min_id), max_id = MAX(max_id, excluded.max_id),
+                        message_count = message_count + excluded.message_count
+                """, [(name, room, min(ids), max(ids), len(ids)) for room, ids in rooms.items()])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.error("Failed to remove archived messages: %s", e)
+            self.connection.rollback()
+            return 0, []
+        return len(batch), sorted({row[10] for row in batch})
+
+    def get_archived_messages(self, limit=100, before=None, room=DEFAULT_ROOM):
+        """Up to `limit` archived messages of a room older than `before`,
+        newest first, shaped like get_message's"""
+        try:
+            self.cursor.execute("""
+                SELECT name, max_id FROM archives WHERE room = ? AND min_id < ?
+                ORDER BY max_id DESC
+            """, (room, before if before is not None else 2 ** 63 - 1))
+            files = self.cursor.fetchall()
+            rows = []
+            for name, max_id in files:
+                # A file whose newest id is below a full page adds nothing
+                if len(rows) >= limit and max_id < rows[limit - 1][0]:
+                    break
+                if not os.path.exists(os.path.join(self.archive_dir, name)):
+                    log.error("Archive file %s is missing", name)
+                    continue
+                rows.extend(self._archive(name).execute(f"""
+                    SELECT {ARCHIVE_COLUMNS} FROM messages
+                    WHERE room = ? AND id < ? ORDER BY id DESC LIMIT ?
+                """, (room, before if before is not None else 2 ** 63 - 1, limit)).fetchall())
+                rows.sort(key=lambda row: row[0], reverse=True)
+            return self._message_dicts(rows[:limit])
+        except sqlite3.Error as e:
+            log.error("Failed to fetch archived messages: %s", e)
+            return []
+
+    def get_archive_ranges(self):
+        """{room: smallest archived message id}"""
+        self.cursor.execute("SELECT room, MIN(min_id) FROM archives GROUP BY room")
+        return dict(self.cursor.fetchall())
+
+    def incremental_vacuum(self, pages=VACUUM_PAGES):
+        """Return up to `pages` free pages to the file system; returns the
+        number of free pages left"""
+        try:
+            # Each step of the pragma frees one page; executescript runs it to the end
+            self.cursor.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+            return self.cursor.execute("PRAGMA freelist_count").fetchone()[0]
+        except sqlite3.Error as e:
+            log.error("Incremental vacuum failed: %s", e)
+            return 0
+
+    def analyze(self):
+        """Refresh the planner's statistics, sampling each index"""
+        try:
+            self.cursor.execute("PRAGMA analysis_limit = 1000")
+            self.cursor.execute("ANALYZE")
+            self.connection.commit()
+        except sqlite3.Error as e:
+            log.error("ANALYZE failed: %s", e)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat database maintenance")
+    parser.add_argument("path", nargs="?", default=DB_PATH, help="database file")
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="rewrite the database so freed space can be returned incrementally "
+                             "(stop the server first; takes time proportional to the file size)")
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    db = chat_db(options.path)
+    if options.enable_incremental_vacuum:
+        log.info("Rewriting %s (%.1f MB) with VACUUM...", options.path, db.size() / 1e6)
+        start = time.perf_counter()
+        if db.enable_incremental_vacuum():
+            log.info("Done in %.1f s, now %.1f MB", time.perf_counter() - start, db.size() / 1e6)
+        else:
+            log.info("Incremental vacuum is already enabled")
+    db.close()
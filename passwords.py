@@ -0,0 +1,148 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+
+log = logging.getLogger(__name__)
+
+# Random bytes of salt stored with every hash
+SALT_SIZE = 16
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def _b64decode(text):
+    return base64.b64decode(text.encode("ascii"))
+
+
+class ScryptHasher:
+    """scrypt with cost parameters n, r and p (memory is about 128 * n * r bytes).
+    Stored as "scrypt$n$r$p$salt$hash"."""
+
+    algorithm = "scrypt"
+
+    def __init__(self, n=2 ** 14, r=8, p=1):
+        self.n, self.r, self.p = n, r, p
+
+    def _derive(self, password, salt, n, r, p):
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r, dklen=32)
+
+    def hash(self, password):
+        salt = os.urandom(SALT_SIZE)
+        key = self._derive(password, salt, self.n, self.r, self.p)
+        return f"{self.algorithm}${self.n}${self.r}${self.p}${_b64encode(salt)}${_b64encode(key)}"
+
+    def verify(self, password, encoded):
+        n, r, p, salt, key = encoded.split("$")[1:]
+        return hmac.compare_digest(self._derive(password, _b64decode(salt), int(n), int(r), int(p)),
+                                   _b64decode(key))
+
+    def is_current(self, encoded):
+        return encoded.split("$")[1:4] == [str(self.n), str(self.r), str(self.p)]
+
+
+class PBKDF2Hasher:
+    """PBKDF2-HMAC-SHA256 with a tunable iteration count.
+    Stored as "pbkdf2_sha256$iterations$salt$hash"."""
+
+    algorithm = "pbkdf2_sha256"
+
+    def __init__(self, iterations=600000):
+        self.iterations = iterations
+
+    def _derive(self, password, salt, iterations):
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+
+    def hash(self, password):
+        salt = os.urandom(SALT_SIZE)
+        key = self._derive(password, salt, self.iterations)
+        return f"{self.algorithm}${self.iterations}${_b64encode(salt)}${_b64encode(key)}"
+
+    def verify(self, password, encoded):
+        iterations, salt, key = encoded.split("$")[1:]
+        return hmac.compare_digest(self._derive(password, _b64decode(salt), int(iterations)),
+                                   _b64decode(key))
+
+    def is_current(self, encoded):
+        return encoded.split("$")[1] == str(self.iterations)
+
+
+class LegacySHA256Hasher:
+    """The original unsalted hex SHA-256; only verified, never produced"""
+
+    algorithm = "sha256"
+
+    def verify(self, password, encoded):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), encoded)
+
+
+HASHERS = {hasher.algorithm: hasher for hasher in (ScryptHasher, PBKDF2Hasher)}
+
+
+def make_hasher(name, cost=None):
+    """A hasher by algorithm name; cost is scrypt's n or PBKDF2's iterations"""
+    hasher = HASHERS.get(name)
+    if hasher is None:
+        raise ValueError(f"Unknown password hasher {name!r}")
+    return hasher() if cost is None else hasher(cost)
+
+
+class PasswordHasher:
+    """Awaitable password hashing with the configured hasher.
+
+    A deliberately slow KDF would stall every connection if it ran on the
+    IOLoop. It runs on a pool of threads instead; hashlib releases the GIL
+    while deriving keys, so logins are spread over all cores. Hashes made
+    by an older hasher or cost still verify and get a replacement hash.
+    """
+
+    def __init__(self, hasher=None, workers=None):
+        self.hasher = hasher or ScryptHasher()
+        self._pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count(),
+                                        thread_name_prefix="password")
+        # A hash of nothing anyone knows, made in the background now so the
+        # first login for an unknown user doesn't pay for it
+        self._dummy_hash = self._pool.submit(self.hasher.hash, secrets.token_hex(16))
+
+    def _hasher_for(self, encoded):
+        algorithm = encoded.split("$", 1)[0]
+        if algorithm in HASHERS:
+            hasher = HASHERS[algorithm]
+            return self.hasher if isinstance(self.hasher, hasher) else hasher()
+        return LegacySHA256Hasher()
+
+    def _verify(self, password, encoded):
+        hasher = self._hasher_for(encoded)
+        try:
+            if not hasher.verify(password, encoded):
+                return False, None
+        except ValueError:
+            log.warning("Malformed password hash")
+            return False, None
+        if hasher is self.hasher and self.hasher.is_current(encoded):
+            return True, None
+        return True, self.hasher.hash(password)
+
+    def hash(self, password):
+        return IOLoop.current().run_in_executor(self._pool, self.hasher.hash, password)
+
+    def verify(self, password, encoded):
+        """Resolves to (matches, new hash to store or None)"""
+        return IOLoop.current().run_in_executor(self._pool, self._verify, password, encoded)
+
+    async def verify_unknown(self, password):
+        """Spend the time of a real check for a user that doesn't exist, so
+        timing logins doesn't tell which usernames do; resolves to False"""
+        await self.verify(password, await asyncio.wrap_future(self._dummy_hash))
+        return False
+
+    def close(self):
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,78 @@
+from tornado.ioloop import IOLoop
+
+# A user whose last connection in a room closed stays online this many
+# seconds, so reloads and reconnects don't flap their presence
+PRESENCE_GRACE = 5.0
+
+
+class PresenceRegistry:
+    """Who is online in each room, counted per connection.
+
+    Each worker counts its own connections per (room, username) and only
+    reports the first one opening and, after the grace period, the last one
+    closing: `publish(room, username, present)` sends that to every worker.
+    Every worker feeds the reports of all of them into `update()` and calls
+    `emit(room, username, status)` when a user goes from no worker to some
+    worker or back, so several tabs, even on different workers, are one user.
+    """
+
+    def __init__(self, emit, publish, grace=PRESENCE_GRACE):
+        self.emit = emit
+        self.publish = publish
+        self.grace = grace
+        # (room, username) -> open connections on this worker
+        self.connections = {}
+        # (room, username) -> pending timeout reporting the last one closed
+        self.leaving = {}
+        # room -> {username: set of workers reporting the user online}
+        self.online = {}
+
+    def connect(self, room, username):
+        key = (room, username)
+        self.connections[key] = self.connections.get(key, 0) + 1
+        if self.connections[key] > 1:
+            return
+        timeout = self.leaving.pop(key, None)
+        if timeout is not None:
+            # Back within the grace period; the others never saw it leave
+            IOLoop.current().remove_timeout(timeout)
+        else:
+            self.publish(room, username, True)
+
+    def disconnect(self, room, username):
+        key = (room, username)
+        count = self.connections.get(key, 0) - 1
+        if count > 0:
+            self.connections[key] = count
+            return
+        self.connections.pop(key, None)
+        if key not in self.leaving:
+            self.leaving[key] = IOLoop.current().call_later(self.grace, self._leave, key)
+
+    def _leave(self, key):
+        del self.leaving[key]
+        self.publish(*key, False)
+
+    def update(self, room, username, worker, present):
+        """A report from any worker, including this one"""
+        users = self.online.setdefault(room, {})
+        workers = users.get(username, set())
+        was_online = bool(workers)
+        if present:
+            workers.add(worker)
+        else:
+            workers.discard(worker)
+
+        if workers:
+            users[username] = workers
+        else:
+            users.pop(username, None)
+            if not users:
+                del self.online[room]
+
+        if bool(workers) != was_online:
+            self.emit(room, username, "online" if workers else "offline")
+
+    def snapshot(self, room):
+        """Usernames currently online in the room"""
+        return sorted(self.online.get(room, ()))
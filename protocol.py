@@ -0,0 +1,74 @@
+import json
+from tornado.escape import json_encode, utf8
+
+# WebSocket subprotocol name of the compact encoding; clients that don't
+# offer it get the original one
+PROTOCOL_V2 = "chat.v2"
+# permessage-deflate settings for compact clients (memLevel 5 keeps the
+# per-connection zlib state small)
+COMPRESSION_OPTIONS = {"compression_level": 5, "mem_level": 5}
+# Small events for compact clients are held this long and sent as one frame
+BATCH_INTERVAL = 0.05
+# Events that are batched; chat messages, edits and deletions go out at once
+BATCHED_TYPES = ("typing", "presence", "read_receipts")
+
+# Compact encoding, one JSON object per event or a JSON array of them:
+#   message           {"t": "m", "i": id, "u": username, "c": content, "ts": timestamp,
+#                      "v": revision, "a": [id, file name, mime type, size]}  ("a" if any)
+#   message_edited    {"t": "e", "i": id, "v": revision, "c": content, "a": [...]}
+#   message_deleted   {"t": "d", "i": id, "v": revision}
+#   sync              {"t": "s", "m": [messages]}
+#   typing            {"t": "y", "u": [usernames]}
+#   presence          {"t": "p", "u": username, "s": 1 online / 0 offline}
+#   presence_snapshot {"t": "P", "u": [usernames]}
+#   read_receipts     {"t": "r", "w": {username: message id}, "s": 1 if snapshot}
+# The connection is bound to one room, so no event repeats it.
+
+
+def compact_attachment(attachment):
+    return [attachment['id'], attachment['file_name'], attachment['mime_type'], attachment['file_size']]
+
+
+def compact_message(message, kind="m"):
+    event = {"t": kind, "i": message['id'], "u": message['username'], "c": message['content'],
+             "ts": message['timestamp'], "v": message.get('revision', 0)}
+    if message.get('attachment'):
+        event["a"] = compact_attachment(message['attachment'])
+    return event
+
+
+def compact(event):
+    """The compact form of an event in the original encoding"""
+    kind = event.get("type")
+    if kind is None:
+        return compact_message(event)
+    if kind == "message_edited":
+        compacted = {"t": "e", "i": event['id'], "v": event['revision'], "c": event['content']}
+        if event.get('attachment'):
+            compacted["a"] = compact_attachment(event['attachment'])
+        return compacted
+    if kind == "message_deleted":
+        return {"t": "d", "i": event['id'], "v": event['revision']}
+    if kind == "sync":
+        return {"t": "s", "m": [compact_message(message) for message in event['messages']]}
+    if kind == "typing":
+        return {"t": "y", "u": event['users']}
+    if kind == "presence":
+        return {"t": "p", "u": event['username'], "s": int(event['status'] == "online")}
+    if kind == "presence_snapshot":
+        return {"t": "P", "u": event['users']}
+    if kind == "read_receipts":
+        return {"t": "r", "w": event['watermarks'], "s": int(event['snapshot'])}
+    return {"t": kind, **{key: value for key, value in event.items() if key != "type"}}
+
+
+def encode(event, compact_form=False):
+    """A frame for one event in either encoding"""
+    if compact_form:
+        return utf8(json.dumps(compact(event), separators=(",", ":")))
+    return utf8(json_encode(event))
+
+
+def encode_batch(events):
+    """One compact frame holding several events, oldest first"""
+    return utf8(json.dumps([compact(event) for event in events], separators=(",", ":")))
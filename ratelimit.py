@@ -0,0 +1,108 @@
+import math
+import time
+from cache import LRUCache
+
+# Users whose buckets are kept; the least recently active one is dropped
+# (and starts over with a full bucket) beyond this
+MAX_BUCKETS = 10000
+# Under backpressure refill rates never drop below this fraction
+MIN_SCALE = 0.1
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`; starts full.
+
+    `scale` multiplies the refill rate for the time since the last call, so
+    a Backpressure factor slows refilling without touching the bucket itself.
+    Only touched from the IOLoop thread.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, scale):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate * scale)
+        self.updated = now
+
+    def consume(self, amount=1, scale=1.0):
+        """Take `amount` tokens if there are that many. Returns 0 when taken,
+        otherwise the seconds until they would be there."""
+        self._refill(scale)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0
+        return (amount - self.tokens) / (self.rate * scale)
+
+    def borrow(self, amount, scale=1.0):
+        """Take `amount` tokens even into debt; returns the seconds until the
+        debt is paid off, which is how long the caller should wait"""
+        self._refill(scale)
+        self.tokens -= amount
+        return max(0.0, -self.tokens / (self.rate * scale))
+
+    def debt(self, scale=1.0):
+        """Seconds until the bucket is out of debt, without taking anything"""
+        self._refill(scale)
+        return max(0.0, -self.tokens / (self.rate * scale))
+
+
+class RateLimiter:
+    """A token bucket per key (username), all with the same rate and burst.
+    A rate of 0 turns the limit off."""
+
+    def __init__(self, rate, burst, pressure=None, max_keys=MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        # Returns the current refill scale, see Backpressure
+        self.pressure = pressure or (lambda: 1.0)
+        self._buckets = LRUCache(max_keys)
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets.set(key, bucket)
+        return bucket
+
+    def consume(self, key, amount=1):
+        if not self.rate:
+            return 0
+        return self._bucket(key).consume(amount, self.pressure())
+
+    def borrow(self, key, amount):
+        if not self.rate:
+            return 0
+        return self._bucket(key).borrow(amount, self.pressure())
+
+    def debt(self, key):
+        if not self.rate:
+            return 0
+        return self._bucket(key).debt(self.pressure())
+
+
+class Backpressure:
+    """Refill scale for rate limits that feed the database writer.
+
+    1.0 while `latency()` (seconds, e.g. AsyncChatDB.write_latency) stays
+    under `target`; above it, target / latency, so admission slows down in
+    proportion to how far behind the writer is. A target of 0 turns it off.
+    """
+
+    def __init__(self, latency, target):
+        self.latency = latency
+        self.target = target
+
+    def __call__(self):
+        latency = self.latency()
+        if not self.target or latency <= self.target:
+            return 1.0
+        return max(MIN_SCALE, self.target / latency)
+
+
+def retry_after(seconds):
+    """Value for a Retry-After header"""
+    return str(max(1, math.ceil(seconds)))
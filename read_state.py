@@ -0,0 +1,89 @@
+import logging
+from tornado.ioloop import PeriodicCallback
+
+log = logging.getLogger(__name__)
+
+# Watermark changes are fanned out and written at most once per interval (seconds)
+RECEIPT_INTERVAL = 1.0
+# Flushes a batch of watermarks may fail before it is given up
+SAVE_ATTEMPTS = 5
+
+
+class ReadWatermarks:
+    """Per-user read positions ("has read up to message id N") in each room.
+
+    Watermarks only move forward, so receipts can be coalesced freely: a
+    room's changes go out once per interval as one diff, `emit(room,
+    {username: message_id})`, and the positions reported to this process are
+    written in one batch per interval by `persist(rows)`, a coroutine taking
+    (user_id, room, message_id) tuples and returning whether they were saved.
+    """
+
+    def __init__(self, emit, persist, interval=RECEIPT_INTERVAL):
+        self.emit = emit
+        self.persist = persist
+        # room -> {username: message_id}, everything seen since startup
+        self.watermarks = {}
+        # room -> {username: message_id} changed since the last flush
+        self.changed = {}
+        # (user_id, room) -> message_id reported here and not written yet
+        self.unsaved = {}
+        # Flushes in a row whose write failed
+        self.failures = 0
+        self.timer = PeriodicCallback(self.flush, interval * 1000)
+
+    def get(self, room, username):
+        return self.watermarks.get(room, {}).get(username, 0)
+
+    def record(self, room, user_id, message_id):
+        """A receipt from one of this process's clients, to be persisted"""
+        key = (user_id, room)
+        if message_id > self.unsaved.get(key, 0):
+            self.unsaved[key] = message_id
+            self._wake()
+
+    def update(self, room, username, message_id):
+        """A watermark from any process, to be fanned out"""
+        if message_id <= self.get(room, username):
+            return
+        self.watermarks.setdefault(room, {})[username] = message_id
+        self.changed.setdefault(room, {})[username] = message_id
+        self._wake()
+
+    def snapshot(self, room, stored):
+        """Stored watermarks of a room overlaid with the newer ones in memory"""
+        watermarks = dict(stored)
+        for username, message_id in self.watermarks.get(room, {}).items():
+            watermarks[username] = max(message_id, watermarks.get(username, 0))
+        return watermarks
+
+    def _wake(self):
+        if not self.timer.is_running():
+            self.timer.start()
+
+    async def flush(self):
+        changed, self.changed = self.changed, {}
+        for room, diff in changed.items():
+            self.emit(room, diff)
+
+        unsaved, self.unsaved = self.unsaved, {}
+        if unsaved:
+            rows = [(user_id, room, message_id) for (user_id, room), message_id in unsaved.items()]
+            try:
+                saved = await self.persist(rows)
+            except Exception as e:
+                log.error("Failed to save read watermarks: %s", e)
+                saved = False
+            if saved:
+                self.failures = 0
+            elif self.failures + 1 >= SAVE_ATTEMPTS:
+                self.failures = 0
+                log.error("Dropping %s read watermarks after %s failed saves", len(rows), SAVE_ATTEMPTS)
+            else:
+                # Retry with the next flush unless newer positions arrived
+                self.failures += 1
+                for key, message_id in unsaved.items():
+                    self.unsaved[key] = max(message_id, self.unsaved.get(key, 0))
+
+        if not self.changed and not self.unsaved:
+            self.timer.stop()
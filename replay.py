@@ -0,0 +1,91 @@
+from collections import OrderedDict, deque
+
+# Events (new messages, edits, deletions) kept per room for clients resuming
+# after a dropped socket
+REPLAY_BUFFER_SIZE = 500
+# Rooms kept; the least recently active one is dropped beyond this and its
+# clients resume from the database instead
+REPLAY_ROOMS = 256
+
+
+class ReplayBuffer:
+    """Recent message events per room, for replaying to reconnecting clients.
+
+    New messages are keyed by their id. Edits and deletions are keyed by the
+    newest message id of the room when they happened, so a client that had
+    seen up to that message but not the change still gets it; replaying a
+    change twice is harmless since clients order them by revision.
+
+    Each room's buffer is known to hold every event a client with a last
+    seen id at or above its floor can have missed. The floor rises as events
+    are pushed out, and starts at the newest id in the database when this
+    process started. `since()` answers from memory only above the floor.
+
+    Only the `max_rooms` most recently active rooms are kept. Dropping a room
+    raises `evicted_floor` past everything it held; rooms not in memory, and
+    rooms added after that, are served only above it.
+    """
+
+    def __init__(self, size=REPLAY_BUFFER_SIZE, max_rooms=REPLAY_ROOMS):
+        self.size = size
+        self.max_rooms = max_rooms
+        # room -> deque of (key, is_change, frame), oldest first; least
+        # recently active room first
+        self.rooms = OrderedDict()
+        # room -> smallest last seen id the buffer can still serve
+        self.floors = {}
+        # room -> newest message id seen
+        self.newest = {}
+        # Newest message id before this process saw any events; None until known
+        self.start_floor = None
+        # Smallest last seen id that rooms dropped from memory can be served from
+        self.evicted_floor = 0
+
+    def start_after(self, message_id):
+        self.start_floor = message_id or 0
+
+    def append(self, room, message_id, frame):
+        events = self._events(room)
+        self.newest[room] = max(self.newest.get(room, 0), message_id)
+        self._push(room, events, (message_id, False, frame))
+
+    def append_change(self, room, frame):
+        events = self._events(room)
+        key = max(self.newest.get(room, 0), self.start_floor or 0)
+        self._push(room, events, (key, True, frame))
+
+    def _events(self, room):
+        """The room's deque, marking it the most recently active"""
+        events = self.rooms.get(room)
+        if events is not None:
+            self.rooms.move_to_end(room)
+            return events
+        events = self.rooms[room] = deque()
+        # Events of an earlier, dropped incarnation of the room are gone
+        self.floors[room] = self.evicted_floor
+        while len(self.rooms) > self.max_rooms:
+            self._evict(next(iter(self.rooms)))
+        return events
+
+    def _evict(self, room):
+        del self.rooms[room]
+        self.floors.pop(room, None)
+        # Every key the room held is at most this, including its changes
+        newest = max(self.newest.pop(room, 0), self.start_floor or 0)
+        self.evicted_floor = max(self.evicted_floor, newest + 1)
+
+    def _push(self, room, events, entry):
+        events.append(entry)
+        if len(events) > self.size:
+            key, is_change, _ = events.popleft()
+            self.floors[room] = max(self.floors.get(room, 0), key + 1 if is_change else key)
+
+    def since(self, room, last_id):
+        """Frames of events a client that has seen up to last_id may have
+        missed, oldest first, or None when the buffer may be missing some"""
+        if self.start_floor is None:
+            return None
+        if last_id < max(self.start_floor, self.floors.get(room, self.evicted_floor)):
+            return None
+        return [frame for key, is_change, frame in self.rooms.get(room, ())
+                if key > last_id or (is_change and key == last_id)]
@@ -15,9 +15,27 @@ class ChatApp {
         this.maxReconnectAttempts = 5;
         this.reconnectDelay = 3000;
         this.currentUser = document.getElementById('app-data')?.dataset.currentUser || 'anonymous';
+        this.room = document.getElementById('app-data')?.dataset.room || 'general';
         this.isTyping = false;
+        this.typingTimeout = null;
+        this.lastTypingSent = 0;
+        // Edit/delete events may arrive out of order or more than once:
+        // deleted ids stay deleted, edits for unseen messages wait for them
+        this.deletedIds = new Set();
+        this.pendingEdits = new Map();
+        // username -> last message id they have read in this room
+        this.readWatermarks = {};
+        this.lastReadSent = 0;
+        this.readTimeout = null;
+        // Usernames online in this room, from a snapshot plus changes
+        this.onlineUsers = new Set();
         
         this.initElements();
+        // Newest message shown; sent on (re)connect so the server replays the gap
+        this.lastMessageId = Math.max(0, ...Array.from(
+            this.elements.messagesContainer.querySelectorAll('.message'),
+            element => Number(element.dataset.id) || 0
+        ));
         this.initEventListeners();
         this.connectWebSocket();
         this.scrollToBottom(true);
@@ -31,7 +49,9 @@ class ChatApp {
             fileInput: document.getElementById('file-input'),
             filePreview: document.getElementById('file-preview'),
             removeFileBtn: document.getElementById('remove-file-btn'),
-            messageForm: document.getElementById('message-form')
+            messageForm: document.getElementById('message-form'),
+            typingIndicator: document.getElementById('typing-indicator'),
+            onlineUsers: document.getElementById('online-users')
         };
     }
 
@@ -55,6 +75,8 @@ class ChatApp {
             }
         });
 
+        document.addEventListener('visibilitychange', () => this.markRead());
+
         fileInput.addEventListener('change', () => this.handleFileSelect());
         removeFileBtn.addEventListener('click', () => this.resetFileInput());
 
@@ -64,11 +86,14 @@ class ChatApp {
     }
 
     connectWebSocket() {
-        this.socket = new WebSocket(`ws://${window.location.host}/ws`);
+        const params = new URLSearchParams({ room: this.room, last_id: this.lastMessageId });
+        // Offer the compact protocol; servers without it answer in the original one
+        this.socket = new WebSocket(`ws://${window.location.host}/ws?${params}`, ['chat.v2']);
 
         this.socket.onopen = () => {
             this.reconnectAttempts = 0;
             this.showToast('Connected to chat', 'success');
+            this.markRead();
         };
 
         this.socket.onclose = () => {
@@ -88,11 +113,12 @@ class ChatApp {
 
         this.socket.onmessage = (event) => {
             try {
-                const message = JSON.parse(event.data);
-                if (message.id && message.content && message.username) {
-                    this.addMessageToUI(message);
+                const data = JSON.parse(event.data);
+                if (event.target.protocol === 'chat.v2') {
+                    // Compact protocol: one event or an array of batched events
+                    (Array.isArray(data) ? data : [data]).forEach(compact => this.handleEvent(this.expandEvent(compact)));
                 } else {
-                    console.error('Invalid message format:', message);
+                    this.handleEvent(data);
                 }
             } catch (error) {
                 console.error('Error parsing message:', error);
@@ -100,6 +126,59 @@ class ChatApp {
         };
     }
 
+    handleEvent(message) {
+        if (message.type === 'typing') {
+            this.showTypingUsers(message.users);
+        } else if (message.type === 'message_edited') {
+            this.applyEdit(message);
+        } else if (message.type === 'message_deleted') {
+            this.applyDelete(message);
+        } else if (message.type === 'sync') {
+            this.applySync(message.messages);
+        } else if (message.type === 'read_receipts') {
+            this.applyReadWatermarks(message.watermarks);
+        } else if (message.type === 'presence_snapshot') {
+            this.onlineUsers = new Set(message.users);
+            this.showOnlineUsers();
+        } else if (message.type === 'presence') {
+            if (message.status === 'online') {
+                this.onlineUsers.add(message.username);
+            } else {
+                this.onlineUsers.delete(message.username);
+            }
+            this.showOnlineUsers();
+        } else if (message.type) {
+            // Unknown event types are ignored
+        } else if (message.id && message.content && message.username) {
+            this.addMessageToUI(message);
+        } else {
+            console.error('Invalid message format:', message);
+        }
+    }
+
+    expandEvent(event) {
+        // Compact protocol events back in the shape of the original protocol
+        const attachment = a => a ? { id: a[0], file_name: a[1], mime_type: a[2], file_size: a[3] } : null;
+        const message = m => ({
+            id: m.i, username: m.u, content: m.c, timestamp: m.ts, revision: m.v, room: this.room,
+            has_attachment: Boolean(m.a), attachment: attachment(m.a)
+        });
+        switch (event.t) {
+            case 'm': return message(event);
+            case 'e': return {
+                type: 'message_edited', id: event.i, revision: event.v, content: event.c, room: this.room,
+                has_attachment: Boolean(event.a), attachment: attachment(event.a)
+            };
+            case 'd': return { type: 'message_deleted', id: event.i, revision: event.v, room: this.room };
+            case 's': return { type: 'sync', messages: event.m.map(message) };
+            case 'y': return { type: 'typing', users: event.u };
+            case 'p': return { type: 'presence', username: event.u, status: event.s ? 'online' : 'offline' };
+            case 'P': return { type: 'presence_snapshot', users: event.u };
+            case 'r': return { type: 'read_receipts', watermarks: event.w, snapshot: Boolean(event.s) };
+            default: return { type: event.t };
+        }
+    }
+
     async sendMessage() {
         const { messageForm } = this.elements;
         const formData = new FormData(messageForm);
@@ -111,12 +190,18 @@ class ChatApp {
             return;
         }
 
+        this.stopTyping();
+
         try {
             this.setSendButtonState(true);
             
             if (file && file.size > 0) {
                 this.showFileUploadStatus('Uploading file...');
+                // Stream the raw file first, then reference it from the message
+                const attachment = await this.uploadFile(file);
+                formData.set('attachment_id', attachment.id);
             }
+            formData.delete('attachment');
 
             const response = await fetch('/api/messages', {
                 method: 'POST',
@@ -137,12 +222,173 @@ class ChatApp {
         }
     }
 
+    async uploadFile(file) {
+        const response = await fetch(`/api/uploads?filename=${encodeURIComponent(file.name)}`, {
+            method: 'POST',
+            headers: { 'Content-Type': file.type || 'application/octet-stream' },
+            body: file
+        });
+
+        const result = await response.json().catch(() => ({}));
+        if (!response.ok) {
+            throw new Error(result.message || 'Failed to upload file');
+        }
+        return result.data;
+    }
+
+    handleTyping() {
+        if (!this.socket || this.socket.readyState !== WebSocket.OPEN) return;
+
+        // Tell the server once, then only refresh before its state expires
+        const now = Date.now();
+        if (!this.isTyping || now - this.lastTypingSent > 3000) {
+            this.socket.send(JSON.stringify({ type: 'typing', is_typing: true }));
+            this.isTyping = true;
+            this.lastTypingSent = now;
+        }
+
+        clearTimeout(this.typingTimeout);
+        this.typingTimeout = setTimeout(() => this.stopTyping(), 2000);
+    }
+
+    stopTyping() {
+        clearTimeout(this.typingTimeout);
+        if (!this.isTyping) return;
+        this.isTyping = false;
+        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+            this.socket.send(JSON.stringify({ type: 'typing', is_typing: false }));
+        }
+    }
+
+    showTypingUsers(users) {
+        const { typingIndicator } = this.elements;
+        if (!typingIndicator) return;
+
+        const others = (users || []).filter(user => user !== this.currentUser);
+        if (others.length === 0) {
+            typingIndicator.textContent = '';
+        } else if (others.length === 1) {
+            typingIndicator.textContent = `${others[0]} is typing...`;
+        } else if (others.length <= 3) {
+            typingIndicator.textContent = `${others.join(', ')} are typing...`;
+        } else {
+            typingIndicator.textContent = 'Several people are typing...';
+        }
+    }
+
+    showOnlineUsers() {
+        const { onlineUsers } = this.elements;
+        if (!onlineUsers) return;
+
+        const users = Array.from(this.onlineUsers).sort();
+        onlineUsers.textContent = `${users.length} online`;
+        onlineUsers.title = users.join(', ');
+    }
+
     addMessageToUI(message) {
         const messagesContainer = this.elements.messagesContainer;
+        // A replay after reconnecting may overlap what's already shown
+        if (this.deletedIds.has(message.id) || this.findMessageElement(message.id)) return;
+        this.lastMessageId = Math.max(this.lastMessageId, message.id);
         const messageElement = this.createMessageElement(message);
         messagesContainer.appendChild(messageElement);
         this.addMessageActionListeners(messageElement);
+        if (this.pendingEdits.has(message.id)) {
+            this.applyEdit(this.pendingEdits.get(message.id));
+            this.pendingEdits.delete(message.id);
+        }
+        this.markSeen(messageElement);
         this.scrollToBottom();
+        this.markRead();
+    }
+
+    markRead() {
+        // One receipt for the newest message, once things settle and only
+        // while the page is actually visible
+        clearTimeout(this.readTimeout);
+        this.readTimeout = setTimeout(() => {
+            if (document.visibilityState !== 'visible') return;
+            if (this.lastMessageId <= this.lastReadSent) return;
+            if (!this.socket || this.socket.readyState !== WebSocket.OPEN) return;
+            this.socket.send(JSON.stringify({ type: 'read_receipt', message_id: this.lastMessageId }));
+            this.lastReadSent = this.lastMessageId;
+        }, 1000);
+    }
+
+    applyReadWatermarks(watermarks) {
+        for (const [username, messageId] of Object.entries(watermarks || {})) {
+            this.readWatermarks[username] = Math.max(this.readWatermarks[username] || 0, messageId);
+        }
+        const seenUpTo = this.seenUpTo();
+        this.elements.messagesContainer.querySelectorAll('.message-right:not(.message-seen)')
+            .forEach(element => this.markSeen(element, seenUpTo));
+    }
+
+    seenUpTo() {
+        // Newest message anyone else has read
+        return Math.max(0, ...Object.entries(this.readWatermarks)
+            .filter(([username]) => username !== this.currentUser)
+            .map(([, messageId]) => messageId));
+    }
+
+    markSeen(messageElement, seenUpTo = this.seenUpTo()) {
+        if (messageElement.classList.contains('message-right') && Number(messageElement.dataset.id) <= seenUpTo) {
+            messageElement.classList.add('message-seen');
+        }
+    }
+
+    findMessageElement(messageId) {
+        return this.elements.messagesContainer.querySelector(`.message[data-id="${messageId}"]`);
+    }
+
+    applyEdit(edit) {
+        if (this.deletedIds.has(edit.id)) return;
+        const messageElement = this.findMessageElement(edit.id);
+        if (!messageElement) {
+            const pending = this.pendingEdits.get(edit.id);
+            if (!pending || pending.revision < edit.revision) {
+                this.pendingEdits.set(edit.id, edit);
+            }
+            return;
+        }
+        // Older or repeated revisions change nothing
+        if (edit.revision <= Number(messageElement.dataset.revision || 0)) return;
+        messageElement.dataset.revision = edit.revision;
+        // Content arrives escaped by the server, as for new messages
+        messageElement.querySelector('.message-content').innerHTML = edit.content;
+        messageElement.querySelector('.attachment')?.remove();
+        if (edit.has_attachment && edit.attachment) {
+            messageElement.insertAdjacentHTML('beforeend', this.createAttachmentHTML(edit.attachment));
+        }
+    }
+
+    applyDelete(deletion) {
+        this.deletedIds.add(deletion.id);
+        this.pendingEdits.delete(deletion.id);
+        this.findMessageElement(deletion.id)?.remove();
+    }
+
+    applySync(messages) {
+        // Current state of the room's newest messages after a long disconnect;
+        // anything shown in that id range but missing from it was deleted.
+        // When the gap was too long to replay, it is all the client gets, so
+        // messages newer than anything shown are added (oldest first)
+        if (!messages.length) return;
+        const lastShown = this.lastMessageId;
+        messages.filter(message => message.id > lastShown)
+            .sort((a, b) => a.id - b.id)
+            .forEach(message => this.addMessageToUI(message));
+        const ids = new Set(messages.map(message => message.id));
+        const oldest = Math.min(...ids);
+        const newest = Math.max(...ids);
+        this.elements.messagesContainer.querySelectorAll('.message').forEach(element => {
+            const id = Number(element.dataset.id);
+            if (id >= oldest && id <= newest && !ids.has(id)) {
+                this.applyDelete({ id });
+            }
+        });
+        messages.filter(message => this.findMessageElement(message.id))
+            .forEach(message => this.applyEdit(message));
     }
 
     createMessageElement(message) {
@@ -150,6 +396,7 @@ class ChatApp {
         const messageElement = document.createElement('div');
         messageElement.className = `message ${alignClass}`;
         messageElement.dataset.id = message.id;
+        messageElement.dataset.revision = message.revision || 0;
         messageElement.dataset.timestamp = new Date(message.timestamp).getTime();
         
         const formattedTime = this.formatTimestamp(message.timestamp);
@@ -179,14 +426,15 @@ class ChatApp {
         if (type === 'image') {
             preview = `
                 <div class="attachment-preview">
-                    <img src="/attachments/${attachment.id}" 
+                    <img src="/attachments/${attachment.id}/thumb" 
                          alt="${attachment.file_name}"
                          loading="lazy">
                 </div>
             `;
         } else if (type === 'video') {
             preview = `
-                <video controls preload="metadata">
+                <video controls preload="none"
+                       poster="/attachments/${attachment.id}/thumb">
                     <source src="/attachments/${attachment.id}" 
                             type="${attachment.mime_type}">
                     Your browser doesn't support video
@@ -312,7 +560,7 @@ class ChatApp {
             })
             .then(response => {
                 if (response.ok) {
-                    messageElement.remove();
+                    this.applyDelete({ id: Number(messageId) });
                     this.showToast('Message deleted', 'success');
                 } else {
                     throw new Error('Failed to delete message');
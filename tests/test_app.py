@@ -0,0 +1,188 @@
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import urllib.parse
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.websocket import websocket_connect
+
+import app
+import config
+import files
+from replay import ReplayBuffer
+
+PASSWORD = "Passw0rd!"
+
+
+def test_parse_byte_range():
+    assert app.parse_byte_range("bytes=0-99", 1000) == (0, 100)
+    assert app.parse_byte_range("bytes=900-", 1000) == (900, 1000)
+    assert app.parse_byte_range("bytes=0-5000", 1000) == (0, 1000)
+    assert app.parse_byte_range("bytes=-100", 1000) == (900, 1000)
+    assert app.parse_byte_range("bytes=-5000", 1000) == (0, 1000)
+
+
+def test_parse_byte_range_unsatisfiable():
+    start, end = app.parse_byte_range("bytes=200-", 100)
+    assert start >= end
+    start, end = app.parse_byte_range("bytes=-0", 100)
+    assert start >= end
+
+
+def test_parse_byte_range_served_whole():
+    for header in ("bytes=5-2", "bytes=0-1,5-6", "items=0-1", "bytes=-", "bytes=a-b"):
+        assert app.parse_byte_range(header, 100) is None, header
+
+
+def test_client_message_drops_file_path():
+    message = {"id": 1, "attachment": {"id": 2, "file_name": "a.txt", "file_path": "/srv/uploads/x"}}
+    assert app.client_message(message)["attachment"] == {"id": 2, "file_name": "a.txt"}
+    assert "file_path" in message["attachment"]
+    assert app.client_message({"id": 1, "attachment": None})["attachment"] is None
+
+
+class Server:
+    """The application listening on a free port, with helpers for a client"""
+
+    def __init__(self, workdir):
+        self.application = app.make_app(db_path=os.path.join(workdir, "chat.db"),
+                                        cookie_secret="test", broker_url="memory")
+        self.application.settings['upload_dir'] = os.path.join(workdir, "uploads")
+        self.server = self.application.listen(0, address="127.0.0.1", max_body_size=files.MAX_FORM_BODY_SIZE)
+        self.port = next(iter(self.server._sockets.values())).getsockname()[1]
+        self.client = AsyncHTTPClient()
+
+    async def close(self):
+        self.server.stop()
+        await self.server.close_all_connections()
+        self.application.settings['db'].close()
+
+    async def fetch(self, path, cookie="", **kwargs):
+        headers = {"Cookie": cookie, **kwargs.pop("headers", {})}
+        return await self.client.fetch(f"http://127.0.0.1:{self.port}{path}", headers=headers,
+                                       follow_redirects=False, raise_error=False, **kwargs)
+
+    async def login(self, username="alice"):
+        body = urllib.parse.urlencode({"username": username, "password": PASSWORD})
+        await self.fetch("/signup", method="POST", body=body)
+        response = await self.fetch("/login", method="POST", body=body)
+        return "; ".join(header.split(";")[0] for header in response.headers.get_list("Set-Cookie"))
+
+    async def post_message(self, cookie, content, **arguments):
+        response = await self.fetch("/api/messages", cookie, method="POST",
+                                    body=urllib.parse.urlencode({"content": content, **arguments}))
+        assert response.code == 201, response.body
+        return json.loads(response.body)["data"]["id"]
+
+    async def resume(self, cookie, last_id):
+        """Frames sent to a client resuming after last_id, up to the sync snapshot"""
+        url = f"ws://127.0.0.1:{self.port}/ws?room=general&last_id={last_id}"
+        connection = await websocket_connect(HTTPRequest(url, headers={"Cookie": cookie}))
+        frames = []
+        while not frames or frames[-1].get("type") != "sync":
+            frames.append(json.loads(await connection.read_message()))
+        connection.close()
+        return frames
+
+
+@pytest.fixture
+def run_app(tmp_path, monkeypatch):
+    """Runs `scenario(server)` against the application on a temporary
+    database, without rate limits"""
+    for name in ("RATE_POSTS", "RATE_UPLOAD_BYTES", "RATE_WS_FRAMES"):
+        monkeypatch.setattr(config, name, 0)
+    # The cheapest scrypt cost keeps signups and logins fast
+    monkeypatch.setattr(config, "PASSWORD_COST", 2 ** 4)
+
+    def run(scenario):
+        async def main():
+            server = Server(str(tmp_path))
+            try:
+                return await scenario(server)
+            finally:
+                await server.close()
+        return asyncio.run(main())
+    return run
+
+
+def test_anonymous_post_is_forbidden(run_app):
+    async def scenario(server):
+        return (await server.fetch("/api/messages", method="POST", body="content=hi")).code
+    assert run_app(scenario) == 403
+
+
+def test_anonymous_head_redirects_to_login(run_app, caplog):
+    async def scenario(server):
+        return [(await server.fetch(path, method="HEAD")).code
+                for path in ("/attachments/1", "/attachments/1/thumb")]
+    assert run_app(scenario) == [302, 302]
+    # The redirect is sent before a handler error could turn it into a 500
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_unknown_username_still_runs_the_kdf(run_app):
+    calls = []
+
+    async def scenario(server):
+        passwords = server.application.settings['db'].passwords
+        verify_unknown = passwords.verify_unknown
+
+        async def spy(password):
+            calls.append(password)
+            return await verify_unknown(password)
+        passwords.verify_unknown = spy
+        body = urllib.parse.urlencode({"username": "nobody", "password": PASSWORD})
+        response = await server.fetch("/login", method="POST", body=body)
+        return response.headers.get("Set-Cookie", "")
+    assert "user=" not in run_app(scenario)
+    assert calls == [PASSWORD]
+
+
+def test_history_hides_attachment_paths(run_app):
+    async def scenario(server):
+        cookie = await server.login()
+        response = await server.fetch("/api/uploads?filename=a.txt", cookie, method="POST", body=b"hello")
+        await server.post_message(cookie, "see attached", attachment_id=json.loads(response.body)["data"]["id"])
+        response = await server.fetch("/api/messages", cookie)
+        return json.loads(response.body)["data"]["messages"][0]["attachment"]
+    attachment = run_app(scenario)
+    assert attachment["file_name"] == "a.txt"
+    assert "file_path" not in attachment
+
+
+@contextlib.contextmanager
+def replay_from_database(ids):
+    """A replay buffer that started after `ids`, so resuming reads the database"""
+    saved = app.WebSocketHandler.replay_buffer
+    buffer = app.WebSocketHandler.replay_buffer = ReplayBuffer()
+    buffer.start_after(ids[-1])
+    try:
+        yield
+    finally:
+        app.WebSocketHandler.replay_buffer = saved
+
+
+def test_gap_is_replayed_from_the_database(run_app):
+    async def scenario(server):
+        cookie = await server.login()
+        ids = [await server.post_message(cookie, f"m{i}") for i in range(3)]
+        with replay_from_database(ids):
+            return await server.resume(cookie, ids[0])
+    frames = run_app(scenario)
+    assert [frame["content"] for frame in frames[:-1]] == ["m1", "m2"]
+
+
+def test_long_gap_gets_only_the_snapshot(run_app, monkeypatch):
+    monkeypatch.setattr(app, "REPLAY_MAX_MESSAGES", 2)
+
+    async def scenario(server):
+        cookie = await server.login()
+        ids = [await server.post_message(cookie, f"m{i}") for i in range(3)]
+        with replay_from_database(ids):
+            return await server.resume(cookie, 0)
+    frames = run_app(scenario)
+    assert len(frames) == 1
+    assert [message["content"] for message in frames[0]["messages"]] == ["m2", "m1", "m0"]
@@ -0,0 +1,96 @@
+from cache import LRUCache, RecentMessages
+
+
+def message(message_id, room="general"):
+    return {"id": message_id, "room": room, "content": f"m{message_id}"}
+
+
+def ids(messages):
+    return [message["id"] for message in messages]
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_cache_invalidate():
+    cache = LRUCache()
+    cache.set("a", 1)
+    cache.invalidate("a")
+    cache.invalidate("missing")
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_recent_messages_miss_until_loaded():
+    recent = RecentMessages(per_room=3)
+    assert recent.get("general", 2) is None
+    recent.load("general", [message(3), message(2), message(1)], False, recent.generation)
+    assert ids(recent.get("general", 2)) == [3, 2]
+    assert ids(recent.get("general", 2, before=3)) == [2, 1]
+
+
+def test_recent_messages_partial_window_misses_unless_complete():
+    recent = RecentMessages(per_room=3)
+    recent.load("general", [message(3), message(2), message(1)], False, recent.generation)
+    # Older messages may exist beyond the window
+    assert recent.get("general", 3, before=2) is None
+    recent.load("small", [message(5, "small")], True, recent.generation)
+    assert ids(recent.get("small", 10)) == [5]
+
+
+def test_recent_messages_load_discarded_after_a_change():
+    recent = RecentMessages()
+    generation = recent.generation
+    recent.remove(1)
+    recent.load("general", [message(1)], True, generation)
+    assert recent.get("general", 1) is None
+
+
+def test_recent_messages_add_keeps_window_size():
+    recent = RecentMessages(per_room=2)
+    recent.load("general", [message(2), message(1)], True, recent.generation)
+    recent.add(message(3))
+    assert ids(recent.get("general", 2)) == [3, 2]
+    assert recent.find(1) is None
+    # The room lost its oldest message, so it is no longer complete
+    assert recent.get("general", 3) is None
+
+
+def test_recent_messages_add_replaces_and_ignores_uncached_rooms():
+    recent = RecentMessages()
+    recent.load("general", [message(2), message(1)], True, recent.generation)
+    edited = {**message(2), "content": "edited"}
+    recent.add(edited)
+    recent.add(message(3, "other"))
+    assert recent.find(2) is edited
+    assert recent.find(3) is None
+    assert len(recent) == 2
+
+
+def test_recent_messages_remove_and_forget():
+    recent = RecentMessages()
+    recent.load("general", [message(2), message(1)], True, recent.generation)
+    recent.remove(2)
+    assert ids(recent.get("general", 5)) == [1]
+    recent.forget("general")
+    assert recent.get("general", 1) is None
+    assert recent.find(1) is None
+
+
+def test_recent_messages_evicts_least_recently_read_room():
+    recent = RecentMessages(max_rooms=2)
+    recent.load("a", [message(1, "a")], True, recent.generation)
+    recent.load("b", [message(2, "b")], True, recent.generation)
+    recent.get("a", 1)
+    recent.load("c", [message(3, "c")], True, recent.generation)
+    assert recent.get("b", 1) is None
+    assert recent.find(2) is None
+    assert ids(recent.get("a", 1)) == [1]
@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+
+import pytest
+
+from passwords import PasswordHasher, PBKDF2Hasher, ScryptHasher, make_hasher
+
+# Cheap costs; these tests are about the formats, not the strength
+SCRYPT_N = 2 ** 4
+PBKDF2_ITERATIONS = 10
+LEGACY_HASH = hashlib.sha256(b"secret").hexdigest()
+
+
+def run(awaitable):
+    """Result of a PasswordHasher call, which must run on an IOLoop"""
+    async def wait():
+        return await awaitable()
+    return asyncio.run(wait())
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(ScryptHasher(n=SCRYPT_N), workers=2)
+    yield hasher
+    hasher.close()
+
+
+@pytest.mark.parametrize("kdf", [ScryptHasher(n=SCRYPT_N), PBKDF2Hasher(PBKDF2_ITERATIONS)])
+def test_hash_verifies_only_the_same_password(kdf):
+    encoded = kdf.hash("secret")
+    assert encoded.startswith(kdf.algorithm + "$")
+    assert kdf.verify("secret", encoded)
+    assert not kdf.verify("Secret", encoded)
+    assert kdf.is_current(encoded)
+
+
+def test_hashes_are_salted():
+    kdf = ScryptHasher(n=SCRYPT_N)
+    assert kdf.hash("secret") != kdf.hash("secret")
+
+
+def test_make_hasher():
+    assert make_hasher("pbkdf2_sha256", 5).iterations == 5
+    assert isinstance(make_hasher("scrypt"), ScryptHasher)
+    with pytest.raises(ValueError):
+        make_hasher("md5")
+
+
+def test_current_hash_needs_no_upgrade(hasher):
+    encoded = run(lambda: hasher.hash("secret"))
+    assert run(lambda: hasher.verify("secret", encoded)) == (True, None)
+    assert run(lambda: hasher.verify("wrong", encoded)) == (False, None)
+
+
+@pytest.mark.parametrize("old", [
+    ScryptHasher(n=SCRYPT_N * 2).hash("secret"),
+    PBKDF2Hasher(PBKDF2_ITERATIONS).hash("secret"),
+    LEGACY_HASH,
+], ids=["scrypt cost", "pbkdf2", "legacy sha256"])
+def test_outdated_hash_is_upgraded(hasher, old):
+    matches, new_hash = run(lambda: hasher.verify("secret", old))
+    assert matches
+    assert new_hash.startswith(f"scrypt${SCRYPT_N}$")
+    assert hasher.hasher.verify("secret", new_hash)
+
+
+def test_wrong_password_for_outdated_hash_is_not_upgraded(hasher):
+    assert run(lambda: hasher.verify("wrong", LEGACY_HASH)) == (False, None)
+
+
+def test_malformed_hash_does_not_match(hasher):
+    assert run(lambda: hasher.verify("secret", "scrypt$16$8$1$not base64$")) == (False, None)
+
+
+def test_verify_unknown_runs_the_kdf(hasher, monkeypatch):
+    calls = []
+    verify = hasher.hasher.verify
+    monkeypatch.setattr(hasher.hasher, "verify", lambda *args: calls.append(args) or verify(*args))
+    assert run(lambda: hasher.verify_unknown("secret")) is False
+    assert len(calls) == 1
@@ -0,0 +1,49 @@
+import json
+
+import protocol
+
+MESSAGE = {"id": 7, "username": "alice", "content": "hi", "timestamp": "2024-01-01 10:00:00",
+           "has_attachment": False, "attachment": None, "room": "general", "revision": 2}
+ATTACHMENT = {"id": 3, "file_name": "a.png", "mime_type": "image/png", "file_size": 10}
+
+
+def test_compact_message():
+    assert protocol.compact(MESSAGE) == {
+        "t": "m", "i": 7, "u": "alice", "c": "hi", "ts": "2024-01-01 10:00:00", "v": 2}
+
+
+def test_compact_message_with_attachment():
+    compacted = protocol.compact({**MESSAGE, "attachment": ATTACHMENT})
+    assert compacted["a"] == [3, "a.png", "image/png", 10]
+
+
+def test_compact_edit_and_delete():
+    edited = {"type": "message_edited", "id": 7, "revision": 3, "content": "new", "attachment": None}
+    assert protocol.compact(edited) == {"t": "e", "i": 7, "v": 3, "c": "new"}
+    deleted = {"type": "message_deleted", "id": 7, "revision": 4}
+    assert protocol.compact(deleted) == {"t": "d", "i": 7, "v": 4}
+
+
+def test_compact_sync_and_small_events():
+    assert protocol.compact({"type": "sync", "room": "general", "messages": [MESSAGE]}) == {
+        "t": "s", "m": [protocol.compact_message(MESSAGE)]}
+    assert protocol.compact({"type": "typing", "users": ["bob"]}) == {"t": "y", "u": ["bob"]}
+    assert protocol.compact({"type": "presence", "username": "bob", "status": "offline"}) == {
+        "t": "p", "u": "bob", "s": 0}
+    assert protocol.compact({"type": "presence_snapshot", "users": ["bob"]}) == {"t": "P", "u": ["bob"]}
+    receipts = {"type": "read_receipts", "room": "general", "watermarks": {"bob": 7}, "snapshot": True}
+    assert protocol.compact(receipts) == {"t": "r", "w": {"bob": 7}, "s": 1}
+
+
+def test_compact_passes_unknown_events_through():
+    assert protocol.compact({"type": "new_thing", "x": 1}) == {"t": "new_thing", "x": 1}
+
+
+def test_encode_both_forms():
+    assert json.loads(protocol.encode(MESSAGE)) == MESSAGE
+    assert json.loads(protocol.encode(MESSAGE, compact_form=True)) == protocol.compact(MESSAGE)
+
+
+def test_encode_batch():
+    events = [{"type": "typing", "users": []}, {"type": "presence_snapshot", "users": ["bob"]}]
+    assert json.loads(protocol.encode_batch(events)) == [{"t": "y", "u": []}, {"t": "P", "u": ["bob"]}]
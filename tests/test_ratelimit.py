@@ -0,0 +1,81 @@
+import pytest
+
+import ratelimit
+from ratelimit import Backpressure, RateLimiter, TokenBucket, retry_after
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_starts_full_and_runs_out(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.consume() for _ in range(3)] == [0, 0, 0]
+    assert bucket.consume() == pytest.approx(0.5)
+
+
+def test_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    bucket.consume(3)
+    clock.now += 1
+    assert bucket.consume(2) == 0
+    clock.now += 100
+    bucket.consume(0)
+    assert bucket.tokens == 3
+
+
+def test_scale_slows_refill(clock):
+    bucket = TokenBucket(rate=2, burst=2)
+    bucket.consume(2)
+    clock.now += 1
+    assert bucket.consume(2, scale=0.5) == pytest.approx(1 / (2 * 0.5))
+
+
+def test_borrow_goes_into_debt(clock):
+    bucket = TokenBucket(rate=10, burst=10)
+    assert bucket.borrow(30) == pytest.approx(2)
+    assert bucket.debt() == pytest.approx(2)
+    clock.now += 1
+    assert bucket.debt() == pytest.approx(1)
+    assert bucket.consume() > 0
+
+
+def test_rate_limiter_keeps_a_bucket_per_key(clock):
+    limiter = RateLimiter(rate=1, burst=1)
+    assert limiter.consume("alice") == 0
+    assert limiter.consume("alice") > 0
+    assert limiter.consume("bob") == 0
+
+
+def test_rate_limiter_zero_rate_is_off(clock):
+    limiter = RateLimiter(rate=0, burst=0)
+    assert limiter.consume("alice", 100) == 0
+    assert limiter.borrow("alice", 100) == 0
+    assert limiter.debt("alice") == 0
+
+
+def test_backpressure_scales_with_latency():
+    latency = 0.0
+    pressure = Backpressure(lambda: latency, target=0.1)
+    assert pressure() == 1.0
+    latency = 0.4
+    assert pressure() == pytest.approx(0.25)
+    latency = 1000
+    assert pressure() == ratelimit.MIN_SCALE
+    assert Backpressure(lambda: 1000, target=0)() == 1.0
+
+
+def test_retry_after_rounds_up_to_whole_seconds():
+    assert retry_after(0) == "1"
+    assert retry_after(1.2) == "2"
@@ -0,0 +1,97 @@
+from replay import ReplayBuffer
+
+
+def test_nothing_served_until_the_start_floor_is_known():
+    buffer = ReplayBuffer()
+    buffer.append("general", 1, "m1")
+    assert buffer.since("general", 0) is None
+
+
+def test_since_returns_events_after_last_id():
+    buffer = ReplayBuffer()
+    buffer.start_after(10)
+    buffer.append("general", 11, "m11")
+    buffer.append("general", 12, "m12")
+    buffer.append("other", 13, "m13")
+    assert buffer.since("general", 10) == ["m11", "m12"]
+    assert buffer.since("general", 11) == ["m12"]
+    assert buffer.since("general", 12) == []
+    assert buffer.since("quiet", 10) == []
+
+
+def test_last_id_below_the_start_floor_falls_back():
+    buffer = ReplayBuffer()
+    buffer.start_after(10)
+    buffer.append("general", 11, "m11")
+    assert buffer.since("general", 9) is None
+
+
+def test_change_is_replayed_to_clients_at_its_key():
+    buffer = ReplayBuffer()
+    buffer.start_after(10)
+    buffer.append("general", 11, "m11")
+    buffer.append_change("general", "edit")
+    # A client that saw message 11 missed the edit made after it
+    assert buffer.since("general", 11) == ["edit"]
+    assert buffer.since("general", 10) == ["m11", "edit"]
+
+
+def test_change_before_any_message_is_keyed_by_the_start_floor():
+    buffer = ReplayBuffer()
+    buffer.start_after(10)
+    buffer.append_change("general", "edit")
+    assert buffer.since("general", 10) == ["edit"]
+
+
+def test_floor_rises_as_events_are_pushed_out():
+    buffer = ReplayBuffer(size=2)
+    buffer.start_after(10)
+    for message_id in (11, 12, 13):
+        buffer.append("general", message_id, f"m{message_id}")
+    assert buffer.floors["general"] == 11
+    assert buffer.since("general", 10) is None
+    assert buffer.since("general", 11) == ["m12", "m13"]
+
+
+def test_pushed_out_change_raises_floor_past_its_key():
+    buffer = ReplayBuffer(size=1)
+    buffer.start_after(10)
+    buffer.append_change("general", "edit")
+    buffer.append("general", 11, "m11")
+    # A client at 10 may have missed the edit, which is gone
+    assert buffer.since("general", 10) is None
+    assert buffer.since("general", 11) == []
+
+
+def test_least_recently_active_room_is_evicted():
+    buffer = ReplayBuffer(max_rooms=2)
+    buffer.start_after(10)
+    buffer.append("a", 11, "a11")
+    buffer.append("b", 12, "b12")
+    buffer.append("a", 13, "a13")
+    buffer.append("c", 14, "c14")
+    assert list(buffer.rooms) == ["a", "c"]
+    assert "b" not in buffer.floors and "b" not in buffer.newest
+
+
+def test_evicted_room_falls_back_below_its_newest_id():
+    buffer = ReplayBuffer(max_rooms=1)
+    buffer.start_after(10)
+    buffer.append("a", 11, "a11")
+    buffer.append("b", 12, "b12")
+    assert buffer.evicted_floor == 12
+    assert buffer.since("a", 10) is None
+    assert buffer.since("a", 11) is None
+    assert buffer.since("a", 12) == []
+    # Rooms that were never evicted keep their own floor
+    assert buffer.since("b", 11) == ["b12"]
+
+
+def test_readded_room_does_not_serve_its_dropped_events():
+    buffer = ReplayBuffer(max_rooms=1)
+    buffer.start_after(10)
+    buffer.append("a", 11, "a11")
+    buffer.append("b", 12, "b12")
+    buffer.append("a", 13, "a13")
+    assert buffer.since("a", 10) is None
+    assert buffer.since("a", 12) == ["a13"]
@@ -0,0 +1,71 @@
+import sqlite3
+
+import pytest
+from tornado.escape import xhtml_escape
+
+import model
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = model.chat_db(str(tmp_path / "chat.db"))
+    db.create_user("alice", "x")
+    yield db
+    db.close()
+
+
+def post(db, content):
+    # Content is stored escaped, as MessageHandler does
+    return db.save_message(1, xhtml_escape(content))
+
+
+def snippets(db, query):
+    return [message["snippet"] for message in db.search_messages(query)]
+
+
+def test_search_matches_words_and_prefixes(db):
+    post(db, "the quick brown fox")
+    post(db, "lazy dog")
+    assert snippets(db, "fox") == ["the quick brown <mark>fox</mark>"]
+    assert snippets(db, "qui") == ["the <mark>quick</mark> brown fox"]
+
+
+def test_search_ignores_html_escaping(db):
+    post(db, "tom & jerry <b>")
+    assert snippets(db, "amp") == []
+    assert snippets(db, "lt") == []
+    assert snippets(db, "jerry") == ["tom &amp; <mark>jerry</mark> &lt;b&gt;"]
+
+
+def test_search_follows_edits(db):
+    message_id = post(db, "fish & chips")
+    db.cursor.execute("UPDATE messages SET content = ? WHERE id = ?", (xhtml_escape("a < b"), message_id))
+    db.connection.commit()
+    assert snippets(db, "chips") == []
+    assert snippets(db, "lt") == []
+    assert snippets(db, "b") == ["a &lt; <mark>b</mark>"]
+    assert db.cursor.execute("SELECT content FROM messages_fts").fetchall() == [("a < b",)]
+
+
+def test_highlight_escapes_the_text():
+    assert model.highlight("<i>fox</i> & co", ["fox"]) == "&lt;i&gt;<mark>fox</mark>&lt;/i&gt; &amp; co"
+    assert model.highlight("no match", ["fox"]) is None
+
+
+def test_migration_reindexes_escaped_content(tmp_path):
+    path = str(tmp_path / "old.db")
+    connection = sqlite3.connect(path)
+    for number, script in enumerate(model.MIGRATIONS[:8], start=1):
+        connection.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;")
+    connection.execute("INSERT INTO users (username, password, creation_time) VALUES ('alice', 'x', 't')")
+    connection.execute("INSERT INTO messages (user_id, content, timestamp) VALUES (1, ?, 't')",
+                       (xhtml_escape("tom & jerry's"),))
+    connection.commit()
+    connection.close()
+
+    db = model.chat_db(path)
+    try:
+        assert db.cursor.execute("SELECT content FROM messages_fts").fetchall() == [("tom & jerry's",)]
+        assert snippets(db, "amp") == []
+    finally:
+        db.close()
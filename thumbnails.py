@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from tornado.ioloop import IOLoop
+from cache import LRUCache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow missing: images are served without thumbnails
+    Image = None
+
+log = logging.getLogger(__name__)
+
+# Longest edge of generated thumbnails and video posters, in pixels
+THUMB_SIZE = 320
+THUMB_QUALITY = 80
+# Stored next to the original as <hash>.thumb.jpg, so blob GC removes it too
+THUMB_SUFFIX = ".thumb.jpg"
+# Seconds into a video the poster frame is taken from
+POSTER_OFFSET = 1
+# Blobs whose thumbnail failed are remembered (up to this many) and not retried
+# until restart, so a corrupt file can't keep the pool busy
+FAILED_BLOBS = 10000
+
+
+def thumbnail_path(file_path, file_hash):
+    return os.path.join(os.path.dirname(file_path), f"{file_hash}{THUMB_SUFFIX}")
+
+
+def can_thumbnail(mime_type):
+    if mime_type.startswith("image/"):
+        return Image is not None
+    if mime_type.startswith("video/"):
+        return shutil.which("ffmpeg") is not None
+    return False
+
+
+def make_thumbnail(source_path, thumb_path, mime_type):
+    """Write a JPEG thumbnail (or video poster frame) for source_path.
+    Runs in a worker process; returns True when the thumbnail was written."""
+    temp_path = f"{thumb_path}.{os.getpid()}.part"
+    try:
+        if mime_type.startswith("image/"):
+            with Image.open(source_path) as image:
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+                image.convert("RGB").save(temp_path, "JPEG", quality=THUMB_QUALITY)
+        else:
+            for offset in (POSTER_OFFSET, 0):
+                result = subprocess.run(
+                    ["ffmpeg", "-v", "error", "-y", "-ss", str(offset), "-i", source_path,
+                     "-frames:v", "1", "-vf", f"scale={THUMB_SIZE}:-2", "-f", "image2", temp_path],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+                # Clips shorter than the offset produce no frame; retry from the start
+                if result.returncode == 0 and os.path.exists(temp_path):
+                    break
+            else:
+                return False
+        os.replace(temp_path, thumb_path)
+        return True
+    except Exception as e:
+        log.error("Could not create thumbnail for %s: %s", source_path, e)
+        return False
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class ThumbnailPipeline:
+    """Generates thumbnails on a process pool, once per blob.
+
+    Decoding and resizing are CPU bound, so they run in separate processes
+    instead of threads; the pool is started on first use.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.pool = None
+        # blob hash -> future of the generation in progress
+        self.pending = {}
+        # blob hash -> True for blobs no thumbnail could be made of
+        self.failed = LRUCache(FAILED_BLOBS)
+
+    def submit(self, file_hash, file_path, mime_type):
+        """Queue a thumbnail for the blob unless it exists or is under way;
+        returns an awaitable resolving to whether a thumbnail is available"""
+        thumb_path = thumbnail_path(file_path, file_hash)
+        if file_hash in self.pending:
+            return self.pending[file_hash]
+
+        future = asyncio.get_running_loop().create_future()
+        if os.path.exists(thumb_path) or not can_thumbnail(mime_type) or self.has_failed(file_hash):
+            future.set_result(os.path.exists(thumb_path))
+            return future
+
+        future = asyncio.ensure_future(self.generate(file_path, thumb_path, mime_type))
+        self.pending[file_hash] = future
+        def done(future):
+            self.pending.pop(file_hash, None)
+            if future.cancelled() or future.exception() or not future.result():
+                self.failed.set(file_hash, True)
+        future.add_done_callback(done)
+        return future
+
+    def has_failed(self, file_hash):
+        return self.failed.get(file_hash, False)
+
+    async def generate(self, file_path, thumb_path, mime_type):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        try:
+            return await IOLoop.current().run_in_executor(
+                self.pool, make_thumbnail, file_path, thumb_path, mime_type)
+        except BrokenProcessPool as e:
+            # A worker died (e.g. killed decoding a hostile image); start afresh
+            log.error("Thumbnail worker pool failed: %s", e)
+            self.pool.shutdown(wait=False)
+            self.pool = None
+            return False
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
@@ -0,0 +1,56 @@
+import time
+from tornado.ioloop import PeriodicCallback
+
+# At most one typing snapshot per room is sent per interval (seconds)
+TYPING_INTERVAL = 0.5
+# A "typing" state that isn't refreshed within this many seconds expires
+TYPING_TTL = 5.0
+
+
+class TypingAggregator:
+    """Coalesces typing updates into periodic per-room snapshots.
+
+    Repeated "is typing" frames from the same user only push back the expiry;
+    a room is re-sent only when its set of typing users actually changed, and
+    then as a single snapshot per tick. `emit(room, usernames)` does the send.
+    """
+
+    def __init__(self, emit, interval=TYPING_INTERVAL, ttl=TYPING_TTL):
+        self.emit = emit
+        self.ttl = ttl
+        # room -> {username: expiry}
+        self.typing = {}
+        self.dirty = set()
+        self.timer = PeriodicCallback(self.flush, interval * 1000)
+
+    def update(self, room, username, is_typing):
+        users = self.typing.setdefault(room, {})
+        if is_typing:
+            if username not in users:
+                self.dirty.add(room)
+            users[username] = time.monotonic() + self.ttl
+        elif users.pop(username, None) is not None:
+            self.dirty.add(room)
+        if not users:
+            del self.typing[room]
+        # The timer only runs while someone is typing or a change is pending
+        if (self.typing or self.dirty) and not self.timer.is_running():
+            self.timer.start()
+
+    def flush(self):
+        now = time.monotonic()
+        for room, users in list(self.typing.items()):
+            expired = [username for username, expiry in users.items() if expiry <= now]
+            for username in expired:
+                del users[username]
+            if expired:
+                self.dirty.add(room)
+            if not users:
+                del self.typing[room]
+
+        for room in self.dirty:
+            self.emit(room, sorted(self.typing.get(room, ())))
+        self.dirty.clear()
+
+        if not self.typing:
+            self.timer.stop()